@@ -4,14 +4,23 @@
 from trytond.pool import Pool
 from .product import *
 from .configuration import *
+from .uom import *
 
 
 def register():
     Pool.register(
+        Uom,
         Configuration,
+        ProductMeasurementsRecomputeQueue,
         Template,
+        Product,
         ProductMeasurementsShapeCreationAsk,
+        ProductMeasurementsRecomputeStart,
+        ProductMeasurementsExportStart,
+        ProductMeasurementsExportResult,
         module='product_measurements_shape', type_='model')
     Pool.register(
         ProductMeasurementsShapeCreation,
+        ProductMeasurementsRecompute,
+        ProductMeasurementsExport,
         module='product_measurements_shape', type_='wizard')
@@ -2,14 +2,39 @@
 # This file is part product_measurements_shape module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import fields
+from timeit import default_timer
+
+from trytond.model import Model, fields
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.pyson import Id
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from product import _SHAPE
+from trytond.rpc import RPC
+from .instrumentation import count, get_stats
+from .product import _SHAPE, STORE_MEASUREMENT_CODE, _to_unicode
+from .shape import SHAPES, shape_selection
 
 __all__ = ['Configuration']
 
+# Templates of each shape on which the formula is checked
+FORMULA_SAMPLE_SIZE = config.getint('product_measurements_shape',
+    'formula_sample_size', default=20)
+# Maximum mean time in milliseconds to compute the code of a template
+FORMULA_TIME_BUDGET = config.getfloat('product_measurements_shape',
+    'formula_time_budget', default=2.0)
+# Maximum length of the computed codes
+FORMULA_MAX_LENGTH = config.getint('product_measurements_shape',
+    'formula_max_length', default=255)
+
+_MEASUREMENT_DEFAULTS = ['shape', 'length_uom', 'height_uom', 'width_uom',
+    'diameter_uom', 'inner_diameter_uom', 'thickness_uom', 'weight_uom',
+    'density_weight_uom', 'density_volume_uom', 'measurement_code_formula',
+    'measurement_code_syntax']
+# Fields whose change checks the formula on the existing templates
+_FORMULA_FIELDS = frozenset(['measurement_code_formula',
+        'measurement_code_syntax'])
+
 
 class Configuration:
     __metaclass__ = PoolMeta
@@ -28,6 +53,13 @@ class Configuration:
     diameter_uom = fields.Many2One('product.uom', 'Diameter UoM',
         domain=[('category', '=', Id('product', 'uom_cat_length'))],
         help='Default value of the Diameter UoM field in template form.')
+    inner_diameter_uom = fields.Many2One('product.uom', 'Inner Diameter UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        help='Default value of the Inner Diameter UoM field in template '
+        'form.')
+    thickness_uom = fields.Many2One('product.uom', 'Thickness UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        help='Default value of the Thickness UoM field in template form.')
     weight_uom = fields.Many2One('product.uom', 'Weight UoM',
         domain=[('category', '=', Id('product', 'uom_cat_weight'))],
         help='Default value of the Weight UoM field in template form.')
@@ -37,21 +69,118 @@ class Configuration:
     density_volume_uom = fields.Many2One('product.uom', 'Density Volume UoM',
         domain=[('category', '=', Id('product', 'uom_cat_volume'))],
         help='Default value of the Density Volume UoM field in template form.')
-    measurement_code_formula = fields.Char('Measurement Code Formula',
-        help="Python expression to compute the code from measurements.\n"
+    measurement_code_syntax = fields.Selection([
+            ('python', 'Python'),
+            ('template', 'Template'),
+            ], 'Measurement Code Syntax', required=True,
+        help='Syntax of the measurement code formula.')
+    measurement_code_formula = fields.Text('Measurement Code Formula',
+        help="Python expression or template to compute the code from "
+        "measurements.\n"
         "It can use the following product template fields:\n"
         "type, shape, length, length_uom, height, height_uom, width, "
-        "width_uom, diameter, diameter_uom, weight, weight_uom, density, "
-        "density_weight_uom, density_volume_uom")
+        "width_uom, diameter, diameter_uom, inner_diameter, "
+        "inner_diameter_uom, thickness, thickness_uom, weight, weight_uom, "
+        "density, density_weight_uom, density_volume_uom\n"
+        "Template lines are \"shape: text\" (\"*\" for any shape) with "
+        "placeholders as {length} or {length:.2f} and optional parts "
+        "between [ ].")
+    measurement_recompute_pending = fields.Function(fields.Integer(
+            'Pending Measurement Recomputes',
+            help='Number of templates waiting in the queue to recompute '
+            'their measurements and code.'),
+        'get_measurement_recompute_pending')
+    _measurement_defaults_cache = Cache(
+        'product_configuration.measurement_defaults', context=False)
 
     @classmethod
     def __setup__(cls):
         super(Configuration, cls).__setup__()
+        cls.shape.selection = shape_selection()
+        cls.__rpc__.update({
+                'get_measurement_stats': RPC(),
+                })
         cls._error_messages.update({
                 'invalid_formula': (
                     'Invalid formula\n%(formula)s\n\n%(error)s'),
+                'invalid_formula_records': (
+                    'The formula\n%(formula)s\n\nfails on the following '
+                    'products:\n%(records)s'),
+                'slow_formula': (
+                    'The formula\n%(formula)s\n\ntakes %(time).3f ms per '
+                    'product, more than the limit of %(budget).3f ms.\n'
+                    'Slowest products:\n%(records)s'),
+                'long_formula_code': (
+                    'The formula\n%(formula)s\n\nreturns codes longer than '
+                    '%(length)s characters on the following products:\n'
+                    '%(records)s'),
                 })
 
+    @staticmethod
+    def default_measurement_code_syntax():
+        return 'python'
+
+    @classmethod
+    def create(cls, vlist):
+        Template = Pool().get('product.template')
+        configurations = super(Configuration, cls).create(vlist)
+        Template._measurement_code_formula_cache.clear()
+        Template._measurement_code_memo.clear()
+        cls._measurement_defaults_cache.clear()
+        cls._check_formula_records([c for c, values in zip(configurations,
+                    vlist) if _FORMULA_FIELDS & set(values)])
+        return configurations
+
+    @classmethod
+    def write(cls, *args):
+        Template = Pool().get('product.template')
+        super(Configuration, cls).write(*args)
+        Template._measurement_code_formula_cache.clear()
+        Template._measurement_code_memo.clear()
+        cls._measurement_defaults_cache.clear()
+        actions = iter(args)
+        to_check = []
+        for configurations, values in zip(actions, actions):
+            if _FORMULA_FIELDS & set(values):
+                to_check.extend(configurations)
+        cls._check_formula_records(to_check)
+        if STORE_MEASUREMENT_CODE and to_check:
+            Template.enqueue_measurement_recompute()
+
+    @classmethod
+    def get_measurement_defaults(cls):
+        '''
+        Return the default shape and UoM ids for templates with the
+        measurement code formula and syntax.
+        The values are cached until the configuration is modified.
+        '''
+        defaults = cls._measurement_defaults_cache.get(None)
+        count('product.configuration.measurement_defaults_cache',
+            defaults is not None)
+        if defaults is None:
+            # Read as singleton to get the default values without record
+            config = cls(1)
+            defaults = {}
+            for fname in _MEASUREMENT_DEFAULTS:
+                value = getattr(config, fname)
+                if isinstance(value, Model):
+                    value = value.id
+                defaults[fname] = value
+            cls._measurement_defaults_cache.set(None, defaults)
+        return defaults.copy()
+
+    def get_measurement_recompute_pending(self, name):
+        Queue = Pool().get('product.measurements_recompute.queue')
+        return Queue.search_count([])
+
+    @classmethod
+    def get_measurement_stats(cls):
+        '''
+        Return the measurement instrumentation counters of the process keyed
+        by hot path name.
+        '''
+        return get_stats()
+
     @staticmethod
     def default_measurement_code_formula():
         return ("'' if self.type == 'service' else "
@@ -60,7 +189,21 @@ class Configuration:
             "(str(self.length)+str(self.length_uom.symbol) if self.length and self.length_uom else '') "
             "if self.shape == 'parallelepiped' else '∅' + (str(self.diameter)+str(self.diameter_uom.symbol) "
             "if self.diameter and self.diameter_uom else '') + ' x ' + (str(self.length)+str(self.length_uom.symbol) "
-            "if self.length and self.length_uom else '') if self.shape == 'cylinder' else ''")
+            "if self.length and self.length_uom else '') if self.shape == 'cylinder' else "
+            "'∅' + (str(self.diameter)+str(self.diameter_uom.symbol) if self.diameter and self.diameter_uom else '') + ' / ∅' + "
+            "(str(self.inner_diameter)+str(self.inner_diameter_uom.symbol) if self.inner_diameter and self.inner_diameter_uom else '') + ' x ' + "
+            "(str(self.length)+str(self.length_uom.symbol) if self.length and self.length_uom else '') "
+            "if self.shape == 'tube' else "
+            "'HEX ' + (str(self.width)+str(self.width_uom.symbol) if self.width and self.width_uom else '') + ' x ' + "
+            "(str(self.length)+str(self.length_uom.symbol) if self.length and self.length_uom else '') "
+            "if self.shape == 'hexagonal' else "
+            "'∅' + (str(self.diameter)+str(self.diameter_uom.symbol) if self.diameter and self.diameter_uom else '') "
+            "if self.shape == 'sphere' else "
+            "'L ' + (str(self.height)+str(self.height_uom.symbol) if self.height and self.height_uom else '') + ' x ' + "
+            "(str(self.width)+str(self.width_uom.symbol) if self.width and self.width_uom else '') + ' x ' + "
+            "(str(self.thickness)+str(self.thickness_uom.symbol) if self.thickness and self.thickness_uom else '') + ' x ' + "
+            "(str(self.length)+str(self.length_uom.symbol) if self.length and self.length_uom else '') "
+            "if self.shape == 'l_profile' else ''")
 
     @classmethod
     def validate(cls, configurations):
@@ -69,7 +212,10 @@ class Configuration:
             configuration.check_formula()
 
     def check_formula(self):
-        'Check formula'
+        '''
+        Check formula on a synthetic template. It is also checked on the
+        existing templates when the formula or its syntax is modified.
+        '''
         pool = Pool()
         ModelData = pool.get('ir.model.data')
         Uom = pool.get('product.uom')
@@ -81,35 +227,102 @@ class Configuration:
         formula = self.measurement_code_formula
         if not formula:
             return
+        syntax = self.measurement_code_syntax or 'python'
 
         product = Template()
         product.type = 'goods'
-        product.shape = 'parallelepiped'
         product.length = product.height = product.width = 0
         product.length_uom = product.height_uom = product.width_uom = meter
         product.diameter = product.weight = product.density = 0
         product.diameter_uom = meter
         product.weight_uom = product.density_weight_uom = kilogram
         product.density_volume_uom = liter
-        context = product._get_context_measurement_code()
-        with Transaction().set_context(**context):
+        product.inner_diameter = product.thickness = 0
+        product.inner_diameter_uom = product.thickness_uom = meter
+        for shape in SHAPES:
+            product.shape = shape
             try:
-                if not isinstance(product.get_measurement_code(formula), str):
-                    raise Exception('The result is not a string.')
+                self._check_formula_code(product, formula, syntax)
             except Exception, error:
                 self.raise_user_error('invalid_formula', {
-                        'formula': formula,
+                        'formula': _to_unicode(formula),
                         'error': error,
                         })
 
-        product.shape = 'cylinder'
-        context = product._get_context_measurement_code()
-        with Transaction().set_context(**context):
+    @classmethod
+    def _check_formula_records(cls, configurations):
+        'Check the formula of configurations on the existing templates'
+        for configuration in configurations:
+            if configuration.measurement_code_formula:
+                configuration.check_formula_records(
+                    configuration.measurement_code_formula,
+                    configuration.measurement_code_syntax or 'python')
+
+    @staticmethod
+    def _check_formula_code(template, formula, syntax):
+        code = template.compute_measurement_code(formula, syntax)
+        if not isinstance(code, basestring):
+            raise Exception('The result is not a string.')
+        return code
+
+    def check_formula_records(self, formula, syntax):
+        '''
+        Compute formula on a sample of the templates of each shape and raise
+        an error with the failing, too long or slowest templates.
+        '''
+        Template = Pool().get('product.template')
+        if not FORMULA_SAMPLE_SIZE:
+            return
+        # Default formulas are byte strings and error messages are unicode
+        formula = _to_unicode(formula)
+        templates = []
+        with Transaction().set_context(active_test=False):
+            for shape in SHAPES:
+                templates.extend(Template.search([
+                            ('shape', '=', shape),
+                            ], order=[('id', 'DESC')],
+                        limit=FORMULA_SAMPLE_SIZE))
+        if not templates:
+            return
+
+        def format_records(records):
+            return u'\n'.join(u'%s: %s' % (t.rec_name, e)
+                for t, e in records)
+
+        # The first pass checks the results and loads the records in cache
+        failed, too_long = [], []
+        for template in templates:
             try:
-                if not isinstance(product.get_measurement_code(formula), str):
-                    raise Exception('The result is not a string.')
+                code = self._check_formula_code(template, formula, syntax)
             except Exception, error:
-                self.raise_user_error('invalid_formula', {
-                        'formula': formula,
-                        'error': error,
-                        })
+                failed.append((template, error))
+                continue
+            if code and len(code) > FORMULA_MAX_LENGTH:
+                too_long.append((template, len(code)))
+        if failed:
+            self.raise_user_error('invalid_formula_records', {
+                    'formula': formula,
+                    'records': format_records(failed),
+                    })
+        if too_long:
+            self.raise_user_error('long_formula_code', {
+                    'formula': formula,
+                    'length': FORMULA_MAX_LENGTH,
+                    'records': format_records(too_long),
+                    })
+
+        times = []
+        for template in templates:
+            start = default_timer()
+            template.compute_measurement_code(formula, syntax)
+            times.append(((default_timer() - start) * 1000, template))
+        mean = sum(t for t, _ in times) / len(times)
+        if mean > FORMULA_TIME_BUDGET:
+            times.sort(key=lambda x: x[0], reverse=True)
+            self.raise_user_error('slow_formula', {
+                    'formula': formula,
+                    'time': mean,
+                    'budget': FORMULA_TIME_BUDGET,
+                    'records': format_records(
+                        (t, '%.3f ms' % ms) for ms, t in times[:5]),
+                    })
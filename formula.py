@@ -0,0 +1,132 @@
+# This file is part product_measurements_shape module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Template syntax for the measurement code formula.
+
+Each line is "<shape>: <template>" where <shape> is a shape name or "*" for
+any other shape. Templates are made of:
+
+- literal text,
+- placeholders "{field}" or "{field:format_spec}" with a field of
+  CODE_TEMPLATE_FIELDS (UoM fields, also written as "{length_uom.symbol}",
+  are replaced by their symbol),
+- optional groups "[...]" rendered only when all their placeholders have a
+  value.
+
+"{{", "}}", "[[" and "]]" are the literal braces and brackets.
+Products of non measurable types always get an empty code.
+'''
+import re
+
+__all__ = ['CODE_TEMPLATE_FIELDS', 'compile_code_template']
+
+CODE_TEMPLATE_FIELDS = ('type', 'shape', 'length', 'length_uom', 'height',
+    'height_uom', 'width', 'width_uom', 'diameter', 'diameter_uom',
+    'inner_diameter', 'inner_diameter_uom', 'thickness', 'thickness_uom',
+    'weight', 'weight_uom', 'density', 'density_weight_uom',
+    'density_volume_uom')
+
+_TOKEN = re.compile(r'\{\{|\}\}|\[\[|\]\]|\{[^{}]*\}|\[|\]|[^\[\]{}]+|.')
+
+
+def _placeholder(token):
+    name, _, spec = token[1:-1].partition(':')
+    name = name.strip()
+    if name.endswith('_uom.symbol'):
+        name = name[:-len('.symbol')]
+    if name not in CODE_TEMPLATE_FIELDS:
+        raise ValueError('Unknown field "%s".' % name)
+    index = CODE_TEMPLATE_FIELDS.index(name)
+    if spec:
+        def render(row):
+            value = row[index]
+            if value:
+                return format(value, spec)
+    else:
+        def render(row):
+            value = row[index]
+            if value:
+                return unicode(value)
+    return render
+
+
+def _compile_line(text):
+    'Return a function rendering the template text for a row'
+    parts = []
+    group = None
+    for token in _TOKEN.findall(text):
+        if token in ('{{', '}}', '[[', ']]'):
+            part = token[0]
+        elif token.startswith('{') and token.endswith('}'):
+            part = _placeholder(token)
+        elif token == '[':
+            if group is not None:
+                raise ValueError('Nested "[" are not allowed.')
+            group = []
+            continue
+        elif token == ']':
+            if group is None:
+                raise ValueError('Unbalanced "]".')
+            parts.append(_group(group))
+            group = None
+            continue
+        elif token in ('{', '}'):
+            raise ValueError('Unbalanced "%s".' % token)
+        else:
+            part = token
+        if group is not None:
+            group.append(part)
+        else:
+            parts.append(part)
+    if group is not None:
+        raise ValueError('Unbalanced "[".')
+
+    def render(row):
+        result = []
+        for part in parts:
+            if callable(part):
+                part = part(row) or u''
+            result.append(part)
+        return u''.join(result)
+    return render
+
+
+def _group(parts):
+    def render(row):
+        result = []
+        for part in parts:
+            if callable(part):
+                part = part(row)
+                if not part:
+                    return
+            result.append(part)
+        return u''.join(result)
+    return render
+
+
+def compile_code_template(formula, non_measurable=('service',)):
+    '''
+    Parse formula once and return a function that renders the code for a
+    tuple of values ordered as CODE_TEMPLATE_FIELDS.
+    '''
+    shapes = {}
+    for line in formula.splitlines():
+        if not line.strip():
+            continue
+        shape, sep, text = line.partition(':')
+        if not sep:
+            raise ValueError('Missing ":" after the shape in "%s".' % line)
+        shapes[shape.strip()] = _compile_line(text.strip())
+    default = shapes.pop('*', None)
+    type_index = CODE_TEMPLATE_FIELDS.index('type')
+    shape_index = CODE_TEMPLATE_FIELDS.index('shape')
+
+    def render(row):
+        if row[type_index] in non_measurable:
+            return u''
+        line = shapes.get(row[shape_index], default)
+        if line is None:
+            return u''
+        return line(row)
+    return render
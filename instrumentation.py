@@ -0,0 +1,146 @@
+# This file is part product_measurements_shape module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Counters of calls, cumulative time and cache hits of the measurement hot
+paths.
+
+Enabled in the trytond configuration file with:
+
+    [product_measurements_shape]
+    instrumentation = True
+
+When disabled, instrumented() returns the function unchanged and count()
+does nothing, so the cost is a boolean test.
+The counters of each transaction are logged at its end and the aggregated
+counters of the process are returned by get_stats().
+'''
+import logging
+import threading
+from functools import wraps
+from timeit import default_timer
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['INSTRUMENTATION', 'instrumented', 'count', 'get_stats',
+    'reset_stats']
+
+INSTRUMENTATION = config.getboolean('product_measurements_shape',
+    'instrumentation', default=False)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _new_stat():
+    return {'calls': 0, 'time': 0.0, 'hits': 0, 'misses': 0}
+
+
+def _add(stats, name, calls=0, time=0.0, hits=0, misses=0):
+    stat = stats.get(name)
+    if stat is None:
+        stat = stats[name] = _new_stat()
+    stat['calls'] += calls
+    stat['time'] += time
+    stat['hits'] += hits
+    stat['misses'] += misses
+
+
+class _StatsDataManager(object):
+    'Collect the counters of a transaction and log them at its end'
+
+    def __init__(self):
+        self.stats = {}
+
+    def __eq__(self, other):
+        return isinstance(other, _StatsDataManager)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(_StatsDataManager)
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        self.log(transaction)
+
+    def tpc_abort(self, transaction):
+        self.log(transaction)
+
+    def log(self, transaction):
+        if self.stats and logger.isEnabledFor(logging.INFO):
+            logger.info('transaction %s stats: %s', id(transaction),
+                ', '.join('%s: %s' % (n, _format(s))
+                    for n, s in sorted(self.stats.iteritems())))
+        self.stats = {}
+
+
+def _format(stat):
+    result = '%(calls)d calls %(time).6fs' % stat
+    if stat['hits'] or stat['misses']:
+        result += ' %d/%d hits' % (stat['hits'],
+            stat['hits'] + stat['misses'])
+    return result
+
+
+def _record(name, **values):
+    with _lock:
+        _add(_stats, name, **values)
+    transaction = Transaction()
+    if transaction.connection is not None:
+        datamanager = transaction.join(_StatsDataManager())
+        _add(datamanager.stats, name, **values)
+
+
+def instrumented(name):
+    'Decorator counting the calls and the time of the function as name'
+    def decorator(func):
+        if not INSTRUMENTATION:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, calls=1, time=default_timer() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, hit):
+    'Count a hit or a miss of the cache name'
+    if INSTRUMENTATION:
+        if hit:
+            _record(name, hits=1)
+        else:
+            _record(name, misses=1)
+
+
+def get_stats():
+    'Return the counters of the process with the hit ratio of caches'
+    with _lock:
+        stats = dict((n, s.copy()) for n, s in _stats.iteritems())
+    for stat in stats.itervalues():
+        lookups = stat['hits'] + stat['misses']
+        stat['hit_ratio'] = float(stat['hits']) / lookups if lookups else None
+    return stats
+
+
+def reset_stats():
+    'Reset the counters of the process'
+    with _lock:
+        _stats.clear()
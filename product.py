@@ -1,26 +1,355 @@
 # This file is part product_measurements_shape module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import ModelView, fields
-from trytond.wizard import Wizard, StateView, StateAction, Button
+from trytond import backend
+from trytond.model import Model, ModelSQL, ModelView, fields
+from trytond.cache import Cache, LRUDictTransaction
+from trytond.wizard import (Wizard, StateView, StateAction, StateTransition,
+    Button)
 from trytond.pyson import PYSONEncoder, Eval, Bool, Id
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.modules.product_measurements.product import NON_MEASURABLE
-from math import pi
+from itertools import chain, izip, product as cartesian_product
+from collections import OrderedDict
+from StringIO import StringIO
+from bisect import bisect_left
+from tempfile import TemporaryFile
+import csv
+import hashlib
+import heapq
+import json
+import logging
+import re
+from sql import Column, Literal, Null
+from sql.functions import CurrentTimestamp
+from sql.operators import Or
+from .formula import CODE_TEMPLATE_FIELDS, compile_code_template
+from .instrumentation import instrumented, count
+from .shape import DIMENSIONS, SHAPES, shape_selection, shapes_with, \
+    shape_volume, shape_volumes
 
-__all__ = ['Template', 'ProductMeasurementsShapeCreationAsk',
-    'ProductMeasurementsShapeCreation']
+logger = logging.getLogger(__name__)
 
-_SHAPE = [
-    (None, 'None'),
-    ('parallelepiped', 'Parallelepiped'),
-    ('cylinder', 'Cylinder'),
-]
+__all__ = ['Template', 'Product', 'ProductMeasurementsShapeCreationAsk',
+    'ProductMeasurementsShapeCreation', 'ProductMeasurementsRecomputeStart',
+    'ProductMeasurementsRecompute', 'ProductMeasurementsRecomputeQueue',
+    'ProductMeasurementsExportStart', 'ProductMeasurementsExportResult',
+    'ProductMeasurementsExport']
+
+_SHAPE = shape_selection()
 
 _MEASUREMENT_FIELDS = ['shape', 'length', 'length_uom', 'height', 'height_uom',
-    'width', 'width_uom', 'diameter', 'diameter_uom', 'weight', 'weight_uom',
+    'width', 'width_uom', 'diameter', 'diameter_uom', 'inner_diameter',
+    'inner_diameter_uom', 'thickness', 'thickness_uom', 'weight', 'weight_uom',
     'density', 'density_weight_uom', 'density_volume_uom']
+# Stored columns computed from the measurements
+_MEASUREMENT_COLUMNS = ['volume_m3', 'length_m', 'height_m', 'width_m',
+    'diameter_m', 'inner_diameter_m', 'thickness_m', 'density_kg_m3',
+    'measurement_signature']
+# Rounding of the normalized values in the measurement signature
+_SIGNATURE_DIGITS = {
+    'length': 6,
+    'height': 6,
+    'width': 6,
+    'diameter': 6,
+    'inner_diameter': 6,
+    'thickness': 6,
+    'density': 3,
+    }
+_GRID_HELP = ('Other values separated by semicolons, in the same UoM. '
+    'A product is created/found for each combination of sizes.')
+_UOM_FIELDS = ['length_uom', 'height_uom', 'width_uom', 'diameter_uom',
+    'inner_diameter_uom', 'thickness_uom', 'weight_uom', 'density_weight_uom',
+    'density_volume_uom']
+
+# Store measurement code in a column instead of computing it on every read
+STORE_MEASUREMENT_CODE = config.getboolean('product_measurements_shape',
+    'store_measurement_code', default=False)
+# Columns of the measurements export
+_EXPORT_FIELDS = ['id', 'code', 'type'] + _MEASUREMENT_FIELDS + [
+    'volume_m3', 'measurement_code']
+# Number of measurement codes memoized by measurement values
+MEASUREMENT_CODE_MEMO_SIZE = config.getint('product_measurements_shape',
+    'measurement_code_memo_size', default=10000)
+# Names a python formula can use to be memoized by measurement values
+_MEMO_NAMES = frozenset(CODE_TEMPLATE_FIELDS + ('self', 'symbol', 'digits',
+        'factor', 'rate', 'True', 'False', 'None', 'str', 'unicode', 'int',
+        'float', 'round', 'abs', 'min', 'max', 'len', 'format', 'replace',
+        'strip', 'lstrip', 'rstrip', 'upper', 'lower', 'join'))
+# Maximum number of queued templates recomputed by each cron call
+RECOMPUTE_QUEUE_LIMIT = config.getint('product_measurements_shape',
+    'recompute_queue_limit', default=10000)
+
+
+def _dimensions(values, uoms):
+    'Return the dimensions of the measurement values in meters'
+    dimensions = {}
+    for name in DIMENSIONS:
+        value, uom = values.get(name), values.get(name + '_uom')
+        if value and uom:
+            dimensions[name] = value * uoms[uom]['factor']
+    return dimensions
+
+
+def compute_volume(values, uoms):
+    '''
+    Return the volume in cubic meters of the measurement values or None if
+    they are not complete. UoMs are referenced by id in values.
+    '''
+    return shape_volume(values.get('shape'), _dimensions(values, uoms))
+
+
+def compute_volumes(vlist, uoms):
+    '''
+    Return the volumes in cubic meters of a list of measurement values
+    computed with the batch function of each shape.
+    '''
+    volumes = [None] * len(vlist)
+    shapes = {}
+    for i, values in enumerate(vlist):
+        shapes.setdefault(values.get('shape'), []).append(i)
+    for shape, indexes in shapes.iteritems():
+        rows = [_dimensions(vlist[i], uoms) for i in indexes]
+        for i, volume in izip(indexes, shape_volumes(shape, rows)):
+            volumes[i] = volume
+    return volumes
+
+
+def compute_weight(values, uoms, volume=None):
+    'Return the weight (unrounded) in weight UoM from volume and density'
+    if volume is None:
+        volume = compute_volume(values, uoms)
+    if (volume and values.get('density') and values.get('weight_uom')
+            and values.get('density_weight_uom')
+            and values.get('density_volume_uom')):
+        return (volume * values['density']
+            * uoms[values['density_weight_uom']]['factor'] * 1000
+            / (uoms[values['weight_uom']]['factor']
+                * uoms[values['density_volume_uom']]['factor']))
+
+
+def compute_density(values, uoms, volume=None):
+    'Return the density (unrounded) in density UoMs from volume and weight'
+    if volume is None:
+        volume = compute_volume(values, uoms)
+    if (volume and values.get('weight') and values.get('weight_uom')
+            and values.get('density_weight_uom')
+            and values.get('density_volume_uom')):
+        return (values['weight'] * uoms[values['weight_uom']]['factor']
+            * uoms[values['density_volume_uom']]['factor']
+            / (volume * uoms[values['density_weight_uom']]['factor'] * 1000))
+
+
+def measurement_signature(code, values, uoms):
+    '''
+    Return a hash of the code, shape and normalized measurements rounded to
+    _SIGNATURE_DIGITS, so the same size entered in other UoMs matches.
+    '''
+    parts = [code or '', values.get('shape') or '']
+    for name in ('length', 'height', 'width', 'diameter'):
+        value, uom = values.get(name), values.get(name + '_uom')
+        if value and uom:
+            parts.append('%.*f' % (_SIGNATURE_DIGITS[name],
+                    value * uoms[uom]['factor']))
+        else:
+            parts.append('')
+    if (values.get('density') and values.get('density_weight_uom')
+            and values.get('density_volume_uom')):
+        parts.append('%.*f' % (_SIGNATURE_DIGITS['density'],
+                values['density']
+                * uoms[values['density_weight_uom']]['factor'] * 1000
+                / uoms[values['density_volume_uom']]['factor']))
+    else:
+        parts.append('')
+    # Added only when set to keep the signature of the other shapes
+    for name in ('inner_diameter', 'thickness'):
+        value, uom = values.get(name), values.get(name + '_uom')
+        if value and uom:
+            parts.append('%s=%.*f' % (name, _SIGNATURE_DIGITS[name],
+                    value * uoms[uom]['factor']))
+    return hashlib.sha1(u'|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def measurement_grid(values, grid):
+    '''
+    Return a list of measurement values, one for each combination of the
+    lists of values in grid keyed by measurement field name.
+    '''
+    names = sorted(grid)
+    vlist = []
+    for combination in cartesian_product(*[grid[n] for n in names]):
+        new_values = values.copy()
+        new_values.update(zip(names, combination))
+        vlist.append(new_values)
+    return vlist
+
+
+def _uom_digits(*uoms):
+    'Return the sum of the digits of uoms read from the UoM metadata cache'
+    Uom = Pool().get('product.uom')
+    metadata = Uom.get_measurement_metadata()
+    return sum(metadata[u.id]['digits'] for u in uoms)
+
+
+def _update_shape_states(cls):
+    '''
+    Hide the dimension fields of cls (with their UoM and size grid fields)
+    which are not used by the selected shape.
+    '''
+    for dimension in DIMENSIONS:
+        invisible = ~Eval('shape').in_(shapes_with(dimension))
+        if dimension in ('length', 'height', 'width'):
+            # Shown without shape as in product_measurements
+            invisible &= Bool(Eval('shape'))
+        for fname in (dimension, dimension + '_uom', dimension + 's'):
+            field = getattr(cls, fname, None)
+            if field is None:
+                continue
+            if field.states.get('invisible'):
+                field.states['invisible'] = (field.states['invisible']
+                    | invisible)
+            else:
+                field.states['invisible'] = invisible
+            if 'shape' not in field.depends:
+                field.depends.append('shape')
+
+
+def _like_regex(pattern, flags=0):
+    'Return the compiled regular expression of a SQL LIKE pattern'
+    regex = []
+    escape = False
+    for char in pattern:
+        if escape:
+            regex.append(re.escape(char))
+            escape = False
+        elif char == '\\':
+            escape = True
+        elif char == '%':
+            regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    return re.compile(''.join(regex) + '$', flags | re.DOTALL | re.UNICODE)
+
+
+def match_code(code, operator, value):
+    'Test code with the operator and value of a domain clause'
+    negative = operator.startswith('not ') or operator == '!='
+    operator = operator[4:] if operator.startswith('not ') else operator
+    if operator in ('=', '!='):
+        result = code == value
+    elif operator == 'in':
+        result = code in value
+    elif operator in ('like', 'ilike'):
+        if code is None or value is None:
+            result = False
+        else:
+            result = bool(_like_regex(value,
+                    re.IGNORECASE if operator == 'ilike' else 0).match(code))
+    else:
+        raise ValueError('Unsupported operator "%s".' % operator)
+    return result != negative
+
+
+def _code_names(code):
+    'Return the global and attribute names used by code and its nested code'
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names |= _code_names(const)
+    return names
+
+
+def nearest_sizes(index, query, k=1, not_smaller=()):
+    '''
+    Return the ids of the k rows of index nearest to query ordered by
+    distance.
+    index is a list of (dimensions, id) sorted by dimensions, query a list of
+    (position, value) in dimensions and not_smaller the positions which must
+    not be smaller than the value. The distance is the sum of the squared
+    relative differences, so dimensions of different magnitude weigh the
+    same. Rows with a missing dimension of query are skipped.
+    When the first dimension is in query, the rows are scanned from its
+    value in both directions and the scan stops when the difference of the
+    first dimension alone is greater than the k-th best distance.
+    '''
+    query = [(i, float(v)) for i, v in query if v]
+    if not query or k <= 0:
+        return []
+    not_smaller = set(not_smaller)
+
+    def distance(dimensions):
+        total = 0.
+        for i, value in query:
+            dimension = dimensions[i]
+            if dimension is None:
+                return
+            if i in not_smaller and dimension < value * (1 - 1e-9):
+                return
+            total += ((dimension - value) / value) ** 2
+        return total
+
+    first = dict(query).get(0)
+    if first is None:
+        distances = ((distance(d), id_) for d, id_ in index)
+        return [id_ for _, id_ in heapq.nsmallest(k,
+                ((d, id_) for d, id_ in distances if d is not None))]
+
+    def bound(position):
+        if 0 <= position < len(index):
+            dimension = index[position][0][0]
+            if dimension is not None:
+                return ((dimension - first) / first) ** 2
+
+    # Max-heap of the k best (distance, id) as (-distance, -id)
+    best = []
+    up = bisect_left(index, ((first,),))
+    down = None if 0 in not_smaller else up - 1
+    while True:
+        up_bound = bound(up)
+        down_bound = bound(down) if down is not None else None
+        if up_bound is None and down_bound is None:
+            break
+        if down_bound is None or (up_bound is not None
+                and up_bound <= down_bound):
+            position, lower = up, up_bound
+            up += 1
+        else:
+            position, lower = down, down_bound
+            down -= 1
+        if len(best) == k and lower > -best[0][0]:
+            break
+        dimensions, id_ = index[position]
+        dist = distance(dimensions)
+        if dist is None:
+            continue
+        if len(best) < k:
+            heapq.heappush(best, (-dist, -id_))
+        elif dist < -best[0][0]:
+            heapq.heapreplace(best, (-dist, -id_))
+    return [-i for _, i in sorted(best, reverse=True)]
+
+
+def _code_template_row(values, uoms):
+    'Return the tuple of CODE_TEMPLATE_FIELDS values with the UoM symbols'
+    row = []
+    for fname in CODE_TEMPLATE_FIELDS:
+        value = values[fname]
+        if fname in _UOM_FIELDS and value:
+            value = uoms[value]['symbol']
+        row.append(value)
+    return tuple(row)
+
+
+def _to_unicode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
 
 
 class Template:
@@ -28,27 +357,62 @@ class Template:
     __name__ = 'product.template'
     shape = fields.Selection(_SHAPE, 'Shape', select=True,
         help="Weight Formula for Parallelepiped = width*height*length*density"
-            "\nWeight Formula for Cylinder = (diameter/2)^2*pi*length*density",
+            "\nWeight Formula for Cylinder = (diameter/2)^2*pi*length*density"
+            "\nWeight Formula for Tube = ((diameter/2)^2 - "
+            "(inner diameter/2)^2)*pi*length*density"
+            "\nWeight Formula for Hexagonal Bar = "
+            "sqrt(3)/2*width^2*length*density (width across flats)"
+            "\nWeight Formula for Sphere = pi/6*diameter^3*density"
+            "\nWeight Formula for L-Profile = "
+            "thickness*(height+width-thickness)*length*density",
         states={
             'invisible': Eval('type').in_(NON_MEASURABLE),
             }, depends=['type'])
     diameter = fields.Float('Diameter',
         digits=(16, Eval('diameter_digits', 2)),
         states={
-            'invisible': ((Eval('type').in_(NON_MEASURABLE)) |
-                (Eval('shape') != 'cylinder')),
+            'invisible': Eval('type').in_(NON_MEASURABLE),
             },
         depends=['type', 'diameter_digits'])
     diameter_uom = fields.Many2One('product.uom', 'Diameter UoM',
         domain=[('category', '=', Id('product', 'uom_cat_length'))],
         states={
-            'invisible': ((Eval('type').in_(NON_MEASURABLE)) |
-                (Eval('shape') != 'cylinder')),
+            'invisible': Eval('type').in_(NON_MEASURABLE),
             'required': Bool(Eval('diameter')),
             },
-        depends=['type', 'shape', 'diameter'])
+        depends=['type', 'diameter'])
     diameter_digits = fields.Function(fields.Integer('Diameter Digits'),
-        'on_change_with_diameter_digits')
+        'get_measurement_digits')
+    inner_diameter = fields.Float('Inner Diameter',
+        digits=(16, Eval('inner_diameter_digits', 2)),
+        states={
+            'invisible': Eval('type').in_(NON_MEASURABLE),
+            },
+        depends=['type', 'inner_diameter_digits'])
+    inner_diameter_uom = fields.Many2One('product.uom', 'Inner Diameter UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        states={
+            'invisible': Eval('type').in_(NON_MEASURABLE),
+            'required': Bool(Eval('inner_diameter')),
+            },
+        depends=['type', 'inner_diameter'])
+    inner_diameter_digits = fields.Function(
+        fields.Integer('Inner Diameter Digits'), 'get_measurement_digits')
+    thickness = fields.Float('Thickness',
+        digits=(16, Eval('thickness_digits', 2)),
+        states={
+            'invisible': Eval('type').in_(NON_MEASURABLE),
+            },
+        depends=['type', 'thickness_digits'])
+    thickness_uom = fields.Many2One('product.uom', 'Thickness UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        states={
+            'invisible': Eval('type').in_(NON_MEASURABLE),
+            'required': Bool(Eval('thickness')),
+            },
+        depends=['type', 'thickness'])
+    thickness_digits = fields.Function(fields.Integer('Thickness Digits'),
+        'get_measurement_digits')
     density = fields.Float('Density',
         digits=(16, Eval('density_digits', 2)),
         states={
@@ -70,91 +434,574 @@ class Template:
             },
         depends=['type', 'density'])
     density_digits = fields.Function(fields.Integer('Density Digits'),
-        'on_change_with_density_digits')
+        'get_measurement_digits')
     measurement_code = fields.Function(fields.Char('Measurement code'),
-        'on_change_with_measurement_code')
+        'get_measurement_codes', searcher='search_measurement_code')
+    volume_m3 = fields.Float('Normalized Volume', readonly=True, select=True,
+        help='Volume in cubic meters computed from the shape measurements. '
+        'Search by this field to compare volumes in any UoM.',
+        states={
+            'invisible': Eval('type').in_(NON_MEASURABLE),
+            }, depends=['type'])
+    length_m = fields.Float('Normalized Length', readonly=True, select=True,
+        help='Length in meters. Search by this field to compare '
+        'lengths in any UoM.')
+    height_m = fields.Float('Normalized Height', readonly=True, select=True,
+        help='Height in meters. Search by this field to compare '
+        'heights in any UoM.')
+    width_m = fields.Float('Normalized Width', readonly=True, select=True,
+        help='Width in meters. Search by this field to compare '
+        'widths in any UoM.')
+    diameter_m = fields.Float('Normalized Diameter', readonly=True,
+        select=True, help='Diameter in meters. Search by this field to '
+        'compare diameters in any UoM.')
+    inner_diameter_m = fields.Float('Normalized Inner Diameter',
+        readonly=True, select=True, help='Inner diameter in meters. Search '
+        'by this field to compare inner diameters in any UoM.')
+    thickness_m = fields.Float('Normalized Thickness', readonly=True,
+        select=True, help='Thickness in meters. Search by this field to '
+        'compare thicknesses in any UoM.')
+    density_kg_m3 = fields.Float('Normalized Density', readonly=True,
+        select=True, help='Density in kilograms per cubic meter. Search by '
+        'this field to compare densities in any UoM.')
+    measurement_signature = fields.Char('Measurement Signature', readonly=True,
+        select=True, help='Hash of the code, shape and normalized '
+        'measurements used to find products with the same measurements.')
+    _measurement_code_formula_cache = Cache(
+        'product_template.measurement_code_formula', context=False)
+    # The memo is disabled when its size is 0 but LRUDict requires a positive
+    # size to be cleared
+    _measurement_code_memo = Cache('product_template.measurement_code_memo',
+        size_limit=max(MEASUREMENT_CODE_MEMO_SIZE, 1), context=False)
+    _measurement_size_index_cache = Cache(
+        'product_template.measurement_size_index', context=False)
 
     @classmethod
     def __setup__(cls):
         super(Template, cls).__setup__()
-        cls.height.states.update({
-                'invisible': ((cls.height.states.get('invisible')) |
-                    (Eval('shape') == 'cylinder'))
-                })
-        cls.height_uom.states.update({
-                'invisible': ((cls.height_uom.states.get('invisible')) |
-                    (Eval('shape') == 'cylinder'))
-                })
-        cls.width.states.update({
-                'invisible': ((cls.height.states.get('invisible')) |
-                    (Eval('shape') == 'cylinder'))
-                })
-        cls.width_uom.states.update({
-                'invisible': ((cls.height_uom.states.get('invisible')) |
-                    (Eval('shape') == 'cylinder'))
+        cls.shape.selection = shape_selection()
+        _update_shape_states(cls)
+        cls.__rpc__.update({
+                'export_measurements': RPC(),
                 })
+        if STORE_MEASUREMENT_CODE:
+            cls.measurement_code = fields.Char('Measurement code',
+                readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        code_exist = TableHandler(cls, module_name).column_exist(
+            'measurement_code')
+
+        super(Template, cls).__register__(module_name)
+
+        # Migration from 4.0: fill the columns computed from measurements
+        cursor.execute(*sql_table.select(sql_table.id,
+                where=sql_table.measurement_signature == Null))
+        ids = [i for i, in cursor.fetchall()]
+        for sub_ids in grouped_slice(ids):
+            cls.update_measurement_columns(cls.browse(sub_ids))
+        if STORE_MEASUREMENT_CODE:
+            if not code_exist:
+                # The code is computed from the records which can not be
+                # read until all modules are registered
+                cls.enqueue_measurement_recompute()
+            if backend.name() == 'postgresql':
+                cls._register_measurement_code_trigram_index()
+
+    @classmethod
+    def _register_measurement_code_trigram_index(cls):
+        '''
+        Create a trigram index on the stored measurement code to search
+        partial codes with (i)like if the pg_trgm extension is installed.
+        Otherwise the btree index of the field is used.
+        '''
+        cursor = Transaction().connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if not cursor.fetchone():
+            logger.warning('pg_trgm extension is not installed, partial '
+                'searches on the measurement code will not use an index.')
+            return
+        cursor.execute('CREATE INDEX IF NOT EXISTS '
+            '"product_template_measurement_code_trgm" '
+            'ON "%s" USING gin ("measurement_code" gin_trgm_ops)'
+            % cls._table)
+
+    @classmethod
+    def create(cls, vlist):
+        # The columns are updated once for the templates and their variants
+        with Transaction().set_context(_update_measurement_columns=False):
+            templates = super(Template, cls).create(vlist)
+        cls.update_measurement_columns(templates, complete=True)
+        if STORE_MEASUREMENT_CODE:
+            cls.store_measurement_code(templates)
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        with Transaction().set_context(_update_measurement_columns=False):
+            super(Template, cls).write(*args)
+        actions = iter(args)
+        to_update = []
+        for templates, values in zip(actions, actions):
+            if set(values) & set(['type', 'code', 'products']
+                    + _MEASUREMENT_FIELDS):
+                to_update.extend(templates)
+            if 'active' in values:
+                cls._measurement_size_index_cache.clear()
+        if to_update:
+            cls.update_measurement_columns(to_update, complete=True)
+            if STORE_MEASUREMENT_CODE:
+                cls.store_measurement_code(to_update)
+
+    @classmethod
+    def delete(cls, templates):
+        super(Template, cls).delete(templates)
+        cls._measurement_size_index_cache.clear()
+
+    @classmethod
+    def _read_measurement_rows(cls, ids=None):
+        '''
+        Yield by chunks a list of the id and a dictionary with the code,
+        measurement values and stored measurement columns of the templates
+        (all if ids is None) read with plain SQL.
+        '''
+        Product = Pool().get('product.product')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        product = Product.__table__()
+        if ids is None:
+            cursor.execute(*table.select(table.id))
+            ids = [i for i, in cursor.fetchall()]
+        names = ['type'] + _MEASUREMENT_FIELDS + _MEASUREMENT_COLUMNS
+        columns = [Column(table, n) for n in names]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            codes = {}
+            cursor.execute(*product.select(product.template, product.code,
+                    where=reduce_ids(product.template, sub_ids)
+                    & (product.code != None),
+                    order_by=product.id.desc))
+            codes.update(cursor.fetchall())
+            cursor.execute(*table.select(table.id, *columns,
+                    where=reduce_ids(table.id, sub_ids)))
+            rows = []
+            for row in cursor.fetchall():
+                values = dict(zip(names, row[1:]))
+                values['code'] = codes.get(row[0])
+                rows.append((row[0], values))
+            yield rows
+
+    @classmethod
+    def _get_measurement_columns(cls, values, uoms, volume=None):
+        '''
+        Return the stored columns computed from the measurement values.
+        volume is the volume in cubic meters if already computed.
+        '''
+        if volume is None:
+            volume = compute_volume(values, uoms)
+        columns = {
+            'volume_m3': volume,
+            'density_kg_m3': None,
+            }
+        for name in DIMENSIONS:
+            value, uom = values[name], values[name + '_uom']
+            columns[name + '_m'] = (value * uoms[uom]['factor']
+                if value is not None and uom else None)
+        if (values['density'] is not None and values['density_weight_uom']
+                and values['density_volume_uom']):
+            columns['density_kg_m3'] = (values['density']
+                * uoms[values['density_weight_uom']]['factor'] * 1000
+                / uoms[values['density_volume_uom']]['factor'])
+        columns['measurement_signature'] = measurement_signature(
+            values['code'], values, uoms)
+        return columns
+
+    @classmethod
+    def find_or_create_measurement_variants(cls, template, vlist):
+        '''
+        Return for each measurement values of vlist the template with the
+        code of template and these measurements. The existing ones are found
+        with a single query and the missing ones are created at once from the
+        variant values of template.
+        '''
+        uoms = cls._get_measurement_uoms()
+        signatures = [measurement_signature(template.code, v, uoms)
+            for v in vlist]
+        found = {}
+        for sub_signatures in grouped_slice(list(set(signatures))):
+            for record in cls.search([
+                        ('measurement_signature', 'in', list(sub_signatures)),
+                        ]):
+                found.setdefault(record.measurement_signature, record)
+        missing = OrderedDict()
+        for signature, values in zip(signatures, vlist):
+            if signature not in found:
+                missing.setdefault(signature, values)
+        if missing:
+            variant_values = template._get_measurement_variant_values()
+            to_create = []
+            for values in missing.itervalues():
+                new_values = variant_values.copy()
+                new_values.update(values)
+                to_create.append(new_values)
+            new_templates = cls.create(to_create)
+            found.update(zip(missing.keys(), new_templates))
+        return [found[s] for s in signatures]
+
+    @classmethod
+    def _measurement_variant_fields(cls):
+        '''
+        Return the names of the fields copied from a template to its new
+        measurement variants. Other modules can extend it to copy their
+        fields. The weight is not copied to be computed from the density.
+        '''
+        return ['name', 'type', 'consumable', 'list_price', 'cost_price',
+            'cost_price_method', 'default_uom', 'active', 'categories',
+            'unique_variant'] + [f for f in _MEASUREMENT_FIELDS
+                if f != 'weight']
+
+    def _get_measurement_variant_values(self):
+        '''
+        Return the values to create a measurement variant of the template
+        with its unique variant product.
+        Only the fields of _measurement_variant_fields are copied: Many2Many
+        are linked to the same records and One2Many are copied.
+        '''
+        fnames = self._measurement_variant_fields()
+        values, = self.read([self.id], fields_names=fnames)
+        del values['id']
+        for fname in fnames:
+            field = self._fields[fname]
+            if field._type == 'many2many':
+                values[fname] = [('add', values[fname])]
+            elif field._type == 'one2many':
+                values[fname] = [('copy', values[fname])]
+        values['products'] = [('create', [{'code': self.code}])]
+        return values
+
+    @classmethod
+    def _get_measurement_size_index(cls, code, shape):
+        '''
+        Return the list of normalized dimensions of the shape and id of the
+        active templates with code and shape sorted by dimensions.
+        The index is cached until the measurements of a template change.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        key = (code, shape)
+        index = cls._measurement_size_index_cache.get(key)
+        count('product.template.measurement_size_index_cache',
+            index is not None)
+        if index is None:
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            product = Product.__table__()
+            columns = [Column(table, d + '_m')
+                for d in SHAPES[shape].dimensions]
+            cursor.execute(*table.select(table.id, *columns,
+                    where=table.id.in_(product.select(product.template,
+                            where=product.code == code))
+                    & (table.shape == shape) & (table.active == True)))
+            index = sorted((tuple(r[1:]), r[0]) for r in cursor.fetchall())
+            cls._measurement_size_index_cache.set(key, index)
+        return index
+
+    @classmethod
+    def find_nearest_sizes(cls, code, shape, dimensions, k=1,
+            not_smaller=None, uom=None):
+        '''
+        Return the k active templates with the code and shape whose
+        dimensions are the nearest to dimensions, a dictionary of dimension
+        name and value in uom (meters if None), ordered by distance.
+        The distance is the sum of the squared relative differences of the
+        dimensions and those in not_smaller must not be smaller than the
+        requested value.
+        '''
+        if shape not in SHAPES:
+            return []
+        names = SHAPES[shape].dimensions
+        for name in chain(dimensions, not_smaller or []):
+            if name not in names:
+                raise ValueError('Shape "%s" has no dimension "%s".'
+                    % (shape, name))
+        factor = 1
+        if uom:
+            factor = cls._get_measurement_uoms()[uom.id]['factor']
+        query = [(names.index(n), v * factor)
+            for n, v in dimensions.iteritems() if v]
+        index = cls._get_measurement_size_index(code, shape)
+        return cls.browse(nearest_sizes(index, query, k,
+                [names.index(n) for n in not_smaller or []]))
+
+    @classmethod
+    def compute_measurement_totals(cls, lines, weight_uom, volume_uom):
+        '''
+        Return the weight in weight_uom and the volume in volume_uom of each
+        line of lines, a list of (template, quantity, uom), and their totals
+        as a dictionary with the keys 'lines' (a list of (weight, volume)),
+        'weight' and 'volume'.
+        The unit weight is the weight of the template or, if not set, the one
+        computed from its volume and density. None is returned for the values
+        that can not be computed and they are not added to the totals.
+        '''
+        Uom = Pool().get('product.uom')
+        uoms = cls._get_measurement_uoms()
+        ids = list(set(t.id for t, _, _ in lines))
+        units = {}
+        for rows in cls._read_measurement_rows(ids):
+            volumes = compute_volumes([v for _, v in rows], uoms)
+            for (id_, values), volume in izip(rows, volumes):
+                if volume is None:
+                    volume = values['volume_m3']
+                if values['weight'] and values['weight_uom']:
+                    weight = (values['weight']
+                        * uoms[values['weight_uom']]['factor'])
+                elif volume and values['density_kg_m3']:
+                    weight = volume * values['density_kg_m3']
+                else:
+                    weight = None
+                # Kilogram and liter have factor one
+                units[id_] = (
+                    weight / uoms[weight_uom.id]['factor']
+                    if weight is not None else None,
+                    volume * 1000 / uoms[volume_uom.id]['factor']
+                    if volume is not None else None)
+
+        result = {'lines': [], 'weight': 0., 'volume': 0.}
+        for template, quantity, uom in lines:
+            if uom and uom != template.default_uom:
+                quantity = Uom.compute_qty(uom, quantity,
+                    template.default_uom, round=False)
+            line = tuple(v * quantity if v is not None else None
+                for v in units[template.id])
+            result['lines'].append(line)
+            for key, value in zip(('weight', 'volume'), line):
+                if value is not None:
+                    result[key] += value
+        return result
+
+    @classmethod
+    def get_measurement_signature(cls, code, values):
+        '''
+        Return the measurement signature of the code and measurement values
+        with UoMs as ids.
+        '''
+        return measurement_signature(code, values,
+            cls._get_measurement_uoms())
+
+    @staticmethod
+    def order_length(tables):
+        table, _ = tables[None]
+        return [table.length_m]
+
+    @staticmethod
+    def order_height(tables):
+        table, _ = tables[None]
+        return [table.height_m]
+
+    @staticmethod
+    def order_width(tables):
+        table, _ = tables[None]
+        return [table.width_m]
+
+    @staticmethod
+    def order_diameter(tables):
+        table, _ = tables[None]
+        return [table.diameter_m]
+
+    @staticmethod
+    def order_inner_diameter(tables):
+        table, _ = tables[None]
+        return [table.inner_diameter_m]
+
+    @staticmethod
+    def order_thickness(tables):
+        table, _ = tables[None]
+        return [table.thickness_m]
+
+    @staticmethod
+    def order_density(tables):
+        table, _ = tables[None]
+        return [table.density_kg_m3]
+
+    @classmethod
+    def update_measurement_columns(cls, templates=None, complete=False):
+        '''
+        Update the stored columns computed from the measurements of the
+        templates (all when templates is None). Only changed rows are written.
+        If complete, the missing weight or density is also filled in the same
+        pass.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        uoms = cls._get_measurement_uoms()
+        ids = None
+        if templates is not None:
+            ids = list(set(t.id for t in templates))
+
+        to_update = {}
+        for rows in cls._read_measurement_rows(ids):
+            volumes = compute_volumes([v for _, v in rows], uoms)
+            for (id_, values), volume in izip(rows, volumes):
+                if complete:
+                    weight, density = cls._compute_weight_density(values,
+                        uoms, volume, missing=True)
+                    columns = cls._get_measurement_columns(
+                        dict(values, weight=weight, density=density), uoms,
+                        volume)
+                    columns.update(weight=weight, density=density)
+                else:
+                    columns = cls._get_measurement_columns(values, uoms,
+                        volume)
+                if any(values[n] != v for n, v in columns.iteritems()):
+                    key = tuple(sorted(columns.iteritems()))
+                    to_update.setdefault(key, []).append(id_)
+
+        for key, template_ids in to_update.iteritems():
+            columns = [Column(table, n) for n, _ in key]
+            values = [v for _, v in key]
+            for sub_ids in grouped_slice(template_ids):
+                cursor.execute(*table.update(columns, values,
+                        where=reduce_ids(table.id, sub_ids)))
+            cls._clear_record_cache(template_ids)
+        if to_update:
+            cls._measurement_size_index_cache.clear()
+
+    @classmethod
+    def _clear_record_cache(cls, ids):
+        'Clear the cached values of the templates updated with plain SQL'
+        transaction = Transaction()
+        # Refresh the local cache of the instances
+        transaction.counter += 1
+        for cache in transaction.cache.itervalues():
+            for cache in [cache] + cache.get('_language_cache', {}).values():
+                if cls.__name__ in cache:
+                    for id_ in ids:
+                        cache[cls.__name__].pop(id_, None)
+
+    @classmethod
+    def store_measurement_code(cls, templates):
+        'Recompute the stored measurement code of the templates'
+        templates = cls.browse(list(set(t.id for t in templates)))
+        new_codes = cls.get_measurement_codes(templates, 'measurement_code')
+        codes = {}
+        for template in templates:
+            code = new_codes[template.id]
+            if code != template.measurement_code:
+                codes.setdefault(code, []).append(template)
+        to_write = []
+        for code, templates in codes.iteritems():
+            to_write.extend((templates, {'measurement_code': code}))
+        if to_write:
+            super(Template, cls).write(*to_write)
 
     @staticmethod
     def default_length_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.length_uom:
-            return config.length_uom.id
+        return Config.get_measurement_defaults()['length_uom']
 
     @staticmethod
     def default_height_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.height_uom:
-            return config.height_uom.id
+        return Config.get_measurement_defaults()['height_uom']
 
     @staticmethod
     def default_width_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.width_uom:
-            return config.width_uom.id
+        return Config.get_measurement_defaults()['width_uom']
 
     @staticmethod
     def default_diameter_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.diameter_uom:
-            return config.diameter_uom.id
+        return Config.get_measurement_defaults()['diameter_uom']
+
+    @staticmethod
+    def default_inner_diameter_uom():
+        Config = Pool().get('product.configuration')
+        return Config.get_measurement_defaults()['inner_diameter_uom']
+
+    @staticmethod
+    def default_thickness_uom():
+        Config = Pool().get('product.configuration')
+        return Config.get_measurement_defaults()['thickness_uom']
 
     @staticmethod
     def default_weight_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.weight_uom:
-            return config.weight_uom.id
+        return Config.get_measurement_defaults()['weight_uom']
 
     @staticmethod
     def default_density_weight_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.density_weight_uom:
-            return config.density_weight_uom.id
+        return Config.get_measurement_defaults()['density_weight_uom']
 
     @staticmethod
     def default_density_volume_uom():
         Config = Pool().get('product.configuration')
-        config = Config.get_singleton()
-        if config and config.density_volume_uom:
-            return config.density_volume_uom.id
+        return Config.get_measurement_defaults()['density_volume_uom']
 
     @fields.depends('diameter_uom')
     def on_change_with_diameter_digits(self, name=None):
-        return (self.diameter_uom.digits if self.diameter_uom
+        return (_uom_digits(self.diameter_uom) if self.diameter_uom
             else self.default_diameter_digits())
 
     @staticmethod
     def default_diameter_digits():
         return 2
 
+    @fields.depends('inner_diameter_uom')
+    def on_change_with_inner_diameter_digits(self, name=None):
+        return (_uom_digits(self.inner_diameter_uom)
+            if self.inner_diameter_uom
+            else self.default_inner_diameter_digits())
+
+    @staticmethod
+    def default_inner_diameter_digits():
+        return 2
+
+    @fields.depends('thickness_uom')
+    def on_change_with_thickness_digits(self, name=None):
+        return (_uom_digits(self.thickness_uom) if self.thickness_uom
+            else self.default_thickness_digits())
+
+    @staticmethod
+    def default_thickness_digits():
+        return 2
+
+    @classmethod
+    def _get_measurement_uoms(cls):
+        'Return the cached values of all UoMs keyed by id'
+        Uom = Pool().get('product.uom')
+        return Uom.get_measurement_metadata()
+
+    @classmethod
+    def get_measurement_digits(cls, templates, names):
+        uoms = cls._get_measurement_uoms()
+        result = dict((n, {}) for n in names)
+        for template in templates:
+            for fname in ('diameter', 'inner_diameter', 'thickness'):
+                if fname + '_digits' not in result:
+                    continue
+                uom = getattr(template, fname + '_uom')
+                result[fname + '_digits'][template.id] = (
+                    uoms[uom.id]['digits'] if uom
+                    else getattr(cls, 'default_%s_digits' % fname)())
+            if 'density_digits' in result:
+                result['density_digits'][template.id] = (
+                    uoms[template.density_weight_uom.id]['digits']
+                    + uoms[template.density_volume_uom.id]['digits']
+                    if template.density_weight_uom
+                    and template.density_volume_uom
+                    else cls.default_density_digits())
+        return result
+
     @fields.depends('density_weight_uom', 'density_volume_uom')
     def on_change_with_density_digits(self, name=None):
-        return (self.density_weight_uom.digits + self.density_volume_uom.digits
+        return (_uom_digits(self.density_weight_uom, self.density_volume_uom)
             if self.density_weight_uom and self.density_volume_uom
             else self.default_density_digits())
 
@@ -162,75 +1009,163 @@ class Template:
     def default_density_digits():
         return 4
 
-    @fields.depends('weight_digits', *_MEASUREMENT_FIELDS)
-    def on_change_with_weight(self, name=None):
+    def _update_measurements(self):
         '''
-        The weight is automatically computed from the measurements and density.
+        Update from the measurements, with one computation of the volume:
+        the weight when it is not set (from the density), the density when
+        it is not set (from the weight), the normalized volume and the
+        measurement code.
         UoM with factor one: Kilogram, Meter, Liter
         Conversion between Density UoM: kg/m^3 = 1000 * kg/l
         '''
-        weight = self.weight
-        if not weight:
-            if self.shape == 'parallelepiped':
-                if (self.density_weight_uom and self.density_volume_uom and
-                        self.density and self.weight_uom and
-                        self.length and self.length_uom and
-                        self.height and self.height_uom and
-                        self.width and self.width_uom):
-                    weight = (self.length * self.length_uom.factor *
-                        self.height * self.height_uom.factor *
-                        self.width * self.width_uom.factor *
-                        self.density * self.density_weight_uom.factor * 1000 /
-                        (self.weight_uom.factor * self.density_volume_uom.factor))
-                    weight = round(weight, self.weight_digits)
-            elif self.shape == 'cylinder':
-                if (self.density_weight_uom and self.density_volume_uom and
-                        self.density and self.weight_uom and
-                        self.length and self.length_uom and
-                        self.diameter and self.diameter_uom):
-                    radius = self.diameter * self.diameter_uom.factor / 2.0
-                    weight = (pi * radius * radius *
-                        self.length * self.length_uom.factor *
-                        self.density * self.density_weight_uom.factor * 1000 /
-                        (self.weight_uom.factor * self.density_volume_uom.factor))
-                    weight = round(weight, self.weight_digits)
-        return weight
-
-    @fields.depends('density_digits', *_MEASUREMENT_FIELDS)
-    def on_change_with_density(self, name=None):
-        '''
-        The density is automatically computed from the measurements and weight.
-        UoM with factor one: Kilogram, Meter, Liter
-        Conversion between Density UoM: kg/m^3 = 1000 * kg/l
+        Config = Pool().get('product.configuration')
+        values = self._get_measurement_values()
+        uoms = self._get_measurement_uoms()
+        volume = compute_volume(values, uoms)
+        self.weight, self.density = self._compute_weight_density(values, uoms,
+            volume, missing=True)
+        self.volume_m3 = volume
+        defaults = Config.get_measurement_defaults()
+        self.measurement_code = self.get_memoized_code(
+            defaults['measurement_code_formula'],
+            defaults['measurement_code_syntax'])
+
+    def _get_measurement_values(self):
+        'Return the measurement values with the UoM ids'
+        values = {}
+        for fname in _MEASUREMENT_FIELDS:
+            value = getattr(self, fname)
+            if fname in _UOM_FIELDS and value:
+                value = value.id
+            values[fname] = value
+        return values
+
+    @classmethod
+    def _compute_weight_density(cls, values, uoms, volume=None,
+            missing=False):
+        '''
+        Return the weight and density of the measurement values rounded to
+        the digits of their UoMs.
+        The weight is computed when the density is set and the density when
+        only the weight is set. If missing, the weight is only computed when
+        it is not set.
+        '''
+        weight, density = values['weight'], values['density']
+        if density and not (missing and weight):
+            computed = compute_weight(values, uoms, volume)
+            if computed is not None:
+                weight = round(computed, uoms[values['weight_uom']]['digits'])
+        elif weight and not density:
+            computed = compute_density(values, uoms, volume)
+            if computed is not None:
+                density = round(computed,
+                    uoms[values['density_weight_uom']]['digits']
+                    + uoms[values['density_volume_uom']]['digits'])
+        return weight, density
+
+    @classmethod
+    def recompute_measurements(cls, templates=None, overwrite=False):
+        '''
+        Recompute in bulk the weight and density of the templates (all when
+        templates is None) and return the updated templates.
+        The weight is computed when the density is set and the density when
+        only the weight is set. The weights already set are only replaced if
+        overwrite. Only the rows that changed are written.
+        The stored measurement columns are also backfilled.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        uoms = cls._get_measurement_uoms()
+        ids = None
+        if templates is not None:
+            ids = [t.id for t in templates]
+
+        to_update = {}
+        for rows in cls._read_measurement_rows(ids):
+            volumes = compute_volumes([v for _, v in rows], uoms)
+            for (id_, values), volume in izip(rows, volumes):
+                weight, density = cls._compute_weight_density(values, uoms,
+                    volume, missing=not overwrite)
+                if (weight, density) != (values['weight'], values['density']):
+                    to_update.setdefault((weight, density), []).append(id_)
+
+        updated = []
+        for (weight, density), template_ids in to_update.iteritems():
+            for sub_ids in grouped_slice(template_ids):
+                cursor.execute(*table.update(
+                        [table.weight, table.density,
+                            table.write_uid, table.write_date],
+                        [weight, density,
+                            transaction.user, CurrentTimestamp()],
+                        where=reduce_ids(table.id, sub_ids)))
+            updated.extend(template_ids)
+        cls._clear_record_cache(updated)
+        updated = cls.browse(updated)
+        cls.update_measurement_columns(templates)
+        if STORE_MEASUREMENT_CODE:
+            cls.store_measurement_code(updated)
+        return updated
+
+    @classmethod
+    def enqueue_measurement_recompute(cls, templates=None, uoms=None):
+        '''
+        Add to the recompute queue the templates, those using one of the uoms
+        or all templates when both are None. Queued templates are skipped.
+        '''
+        Queue = Pool().get('product.measurements_recompute.queue')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        queue = Queue.__table__()
+        queued = Queue.__table__()
+
+        where = ~table.id.in_(queued.select(queued.template))
+        if uoms is not None:
+            uom_ids = [u.id for u in uoms]
+            if not uom_ids:
+                return
+            where &= Or([Column(table, f).in_(uom_ids) for f in _UOM_FIELDS])
+        if templates is None:
+            sub_wheres = [where]
+        else:
+            sub_wheres = [where & reduce_ids(table.id, sub_ids)
+                for sub_ids in grouped_slice(list(set(t.id
+                            for t in templates)))]
+        for sub_where in sub_wheres:
+            cursor.execute(*queue.insert(
+                    [queue.template, queue.create_uid, queue.create_date],
+                    table.select(table.id, Literal(transaction.user),
+                        CurrentTimestamp(), where=sub_where)))
+
+    @classmethod
+    def process_measurement_recompute_queue(cls, limit=None):
+        '''
+        Recompute the measurements and stored code of the first queued
+        templates (at most limit) by chunks and remove them from the queue.
+        The weight of the templates with a density is recomputed so it
+        follows the changes of the UoMs.
         '''
-        density = self.density
-        if not density:
-            if self.shape == 'parallelepiped':
-                if (self.density_weight_uom and self.density_volume_uom and
-                        self.weight and self.weight_uom and
-                        self.length and self.length_uom and
-                        self.height and self.height_uom and
-                        self.width and self.width_uom):
-                    density = (self.weight * self.weight_uom.factor *
-                        self.density_volume_uom.factor / (
-                        self.length * self.length_uom.factor *
-                        self.height * self.height_uom.factor *
-                        self.width * self.width_uom.factor *
-                        self.density_weight_uom.factor * 1000))
-                    density = round(density, self.density_digits)
-            elif self.shape == 'cylinder':
-                if (self.density_weight_uom and self.density_volume_uom and
-                        self.weight and self.weight_uom and
-                        self.length and self.length_uom and
-                        self.diameter and self.diameter_uom):
-                    radius = self.diameter * self.diameter_uom.factor / 2.0
-                    density = (self.weight * self.weight_uom.factor *
-                        self.density_volume_uom.factor /
-                        (pi * radius * radius *
-                        self.length * self.length_uom.factor *
-                        self.density_weight_uom.factor * 1000))
-                    density = round(density, self.density_digits)
-        return density
+        Queue = Pool().get('product.measurements_recompute.queue')
+        cursor = Transaction().connection.cursor()
+        queue = Queue.__table__()
+        if limit is None:
+            limit = RECOMPUTE_QUEUE_LIMIT
+
+        cursor.execute(*queue.select(queue.template, order_by=queue.id,
+                limit=limit))
+        ids = list(OrderedDict.fromkeys(i for i, in cursor.fetchall()))
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            templates = cls.browse(sub_ids)
+            cls.recompute_measurements(templates, overwrite=True)
+            if STORE_MEASUREMENT_CODE:
+                cls.store_measurement_code(templates)
+            cursor.execute(*queue.delete(
+                    where=reduce_ids(queue.template, sub_ids)))
+        if ids:
+            logger.info('Recomputed measurements of %s templates, '
+                '%s remaining.', len(ids), Queue.search_count([]))
 
     def _get_context_measurement_code(self):
         '''
@@ -247,6 +1182,10 @@ class Template:
             'width_uom': self.width_uom,
             'diameter': self.diameter,
             'diameter_uom': self.diameter_uom,
+            'inner_diameter': self.inner_diameter,
+            'inner_diameter_uom': self.inner_diameter_uom,
+            'thickness': self.thickness,
+            'thickness_uom': self.thickness_uom,
             'weight': self.weight,
             'weight_uom': self.weight_uom,
             'density': self.density,
@@ -254,31 +1193,347 @@ class Template:
             'density_volume_uom': self.density_volume_uom,
         }
 
+    @classmethod
+    def compile_measurement_code_formula(cls, formula, syntax='python'):
+        '''
+        Return the formula compiled as code object or, for template syntax,
+        as a function rendering a tuple of CODE_TEMPLATE_FIELDS values.
+        Compiled formulas are cached by database, syntax and formula text.
+        '''
+        key = (syntax, formula)
+        code = cls._measurement_code_formula_cache.get(key)
+        count('product.template.measurement_code_formula_cache',
+            code is not None)
+        if code is None:
+            if syntax == 'template':
+                code = compile_code_template(formula, NON_MEASURABLE)
+            else:
+                code = compile(formula, '<measurement_code_formula>', 'eval')
+            cls._measurement_code_formula_cache.set(key, code)
+        return code
+
+    @instrumented('product.template.get_measurement_code')
     def get_measurement_code(self, formula):
         'Evaluates the formula to compute measurement code'
         if not formula:
             return
-        return eval(formula)
+        return eval(self.compile_measurement_code_formula(formula))
 
-    @fields.depends('type', *_MEASUREMENT_FIELDS)
-    def on_change_with_measurement_code(self, name=None):
-        code = None
-        Config = Pool().get('product.configuration')
-        config = Config(1)
-        if config and config.measurement_code_formula:
+    @instrumented('product.template.compute_measurement_code')
+    def compute_measurement_code(self, formula, syntax='python'):
+        'Return the measurement code of formula written in syntax'
+        if not formula:
+            return
+        if syntax != 'template':
             with Transaction().set_context(
                     self._get_context_measurement_code()):
-                code = self.get_measurement_code(
-                    config.measurement_code_formula)
+                return _to_unicode(self.get_measurement_code(formula))
+        render = self.compile_measurement_code_formula(formula, syntax)
+        values = self._get_measurement_values()
+        values['type'] = self.type
+        return render(_code_template_row(values,
+                self._get_measurement_uoms()))
+
+    @classmethod
+    @instrumented('product.template.get_measurement_codes')
+    def get_measurement_codes(cls, templates, name):
+        'Compute the measurement code of templates with the cached formula'
+        Config = Pool().get('product.configuration')
+        codes = dict((t.id, None) for t in templates)
+        defaults = Config.get_measurement_defaults()
+        formula = defaults['measurement_code_formula']
+        if not formula:
+            return codes
+        syntax = defaults['measurement_code_syntax']
+        for template in templates:
+            codes[template.id] = template.get_memoized_code(formula, syntax)
+        return codes
+
+    @classmethod
+    def _get_measurement_codes_from_rows(cls, rows):
+        '''
+        Return the measurement codes of the rows of _read_measurement_rows.
+        Stored codes are read and template syntax is rendered from the rows,
+        python formulas are evaluated on the records of the rows.
+        '''
+        Config = Pool().get('product.configuration')
+        ids = [i for i, _ in rows]
+        if STORE_MEASUREMENT_CODE:
+            cursor = Transaction().connection.cursor()
+            table = cls.__table__()
+            cursor.execute(*table.select(table.id, table.measurement_code,
+                    where=reduce_ids(table.id, ids)))
+            return dict(cursor.fetchall())
+        defaults = Config.get_measurement_defaults()
+        formula = defaults['measurement_code_formula']
+        syntax = defaults['measurement_code_syntax']
+        if not formula:
+            return {}
+        if syntax != 'template':
+            return cls.get_measurement_codes(cls.browse(ids),
+                'measurement_code')
+        render = cls.compile_measurement_code_formula(formula, syntax)
+        uoms = cls._get_measurement_uoms()
+        return dict((i, render(_code_template_row(v, uoms))) for i, v in rows)
+
+    @classmethod
+    def export_measurement_rows(cls, ids=None):
+        '''
+        Yield the names of _EXPORT_FIELDS and a list of their values for the
+        templates (all if ids is None) with the symbols of the UoMs.
+        Values are read by chunks with plain SQL so memory does not grow with
+        the number of templates.
+        '''
+        uoms = cls._get_measurement_uoms()
+        yield list(_EXPORT_FIELDS)
+        for rows in cls._read_measurement_rows(ids):
+            codes = cls._get_measurement_codes_from_rows(rows)
+            for id_, values in rows:
+                values['id'] = id_
+                values['measurement_code'] = codes.get(id_)
+                row = []
+                for fname in _EXPORT_FIELDS:
+                    value = values[fname]
+                    if fname in _UOM_FIELDS and value:
+                        value = uoms[value]['symbol']
+                    row.append(value)
+                yield row
+
+    @classmethod
+    def _get_export_measurement_ids(cls, ids=None, offset=0, limit=None):
+        '''
+        Return the ids of the templates to export (all if ids is None) from
+        offset to limit ordered by id, with the record rules and active_test
+        of the context applied.
+        '''
+        cursor = Transaction().connection.cursor()
+        domain = []
+        if ids is not None:
+            domain.append(('id', 'in', ids))
+        cursor.execute(*cls.search(domain, offset=offset, limit=limit,
+                order=[('id', 'ASC')], query=True))
+        return [i for i, in cursor.fetchall()]
+
+    @classmethod
+    def iter_export_measurements(cls, format_='csv', ids=None, offset=0,
+            limit=None):
+        '''
+        Yield by lines the measurements export of the templates (all if ids
+        is None) from offset to limit as CSV or as JSON (a list of objects).
+        The CSV header is only written on the first page.
+        '''
+        rows = cls.export_measurement_rows(
+            cls._get_export_measurement_ids(ids, offset, limit))
+        header = next(rows)
+        if format_ == 'json':
+            yield u'['
+            separator = u'\n'
+            for row in rows:
+                yield separator + json.dumps(OrderedDict(izip(header, row)))
+                separator = u',\n'
+            yield u'\n]\n'
+            return
+        buf = StringIO()
+        writer = csv.writer(buf)
+        if not offset:
+            rows = chain([header], rows)
+        for row in rows:
+            writer.writerow([v.encode('utf-8') if isinstance(v, unicode)
+                    else v for v in row])
+            yield buf.getvalue().decode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+
+    @classmethod
+    def export_measurements(cls, format_='csv', ids=None, offset=0,
+            limit=None):
+        '''
+        Return the measurements export of the templates (all if ids is None)
+        from offset to limit as CSV or JSON text.
+        Large catalogues must be exported by pages with limit to not build
+        the whole export in memory.
+        '''
+        return u''.join(cls.iter_export_measurements(format_, ids, offset,
+                limit))
+
+    @classmethod
+    def _get_measurement_code_memo_fields(cls, formula, syntax='python'):
+        '''
+        Return the CODE_TEMPLATE_FIELDS used by formula or None if the code
+        may depend on other values and can not be memoized.
+        '''
+        key = ('memo_fields', syntax, formula)
+        fnames = cls._measurement_code_formula_cache.get(key)
+        if fnames is None:
+            if syntax == 'template':
+                names = set(re.findall(r'\w+', formula))
+            else:
+                names = _code_names(
+                    cls.compile_measurement_code_formula(formula, syntax))
+                if not names <= _MEMO_NAMES:
+                    names = None
+            if names is None:
+                fnames = False
+            else:
+                fnames = tuple(f for f in CODE_TEMPLATE_FIELDS
+                    if f in names or f in ('type', 'shape'))
+            cls._measurement_code_formula_cache.set(key, fnames)
+        return fnames or None
+
+    def get_memoized_code(self, formula, syntax='python'):
+        '''
+        Return the measurement code of formula from the memo shared by all
+        transactions, keyed by the formula and the measurement values it
+        uses (UoMs as ids), or compute and memoize it.
+        The memo is cleared when the configuration or a UoM is modified.
+        '''
+        if not formula:
+            return
+        fnames = None
+        if MEASUREMENT_CODE_MEMO_SIZE > 0:
+            fnames = self._get_measurement_code_memo_fields(formula, syntax)
+        if fnames is None:
+            return self.compute_measurement_code(formula, syntax)
+        values = self._get_measurement_values()
+        values['type'] = self.type
+        key = ((hash((syntax, formula)), Transaction().language)
+            + tuple(values[f] for f in fnames))
+        code = self._measurement_code_memo.get(key)
+        count('product.template.measurement_code_memo', code is not None)
+        if code is None:
+            code = self.compute_measurement_code(formula, syntax)
+            self._measurement_code_memo.set(key, code)
         return code
 
-    def __getattr__(self, name):
-        val = super(Template, self).__getattr__(name)
-        if name == 'name':
-            code = self.measurement_code
-            if code:
-                val += ' [' + unicode(code, "utf-8") + ']'
-        return val
+    def get_memoized_measurement_code(self):
+        '''
+        Return the measurement code memoized for the current transaction.
+        The memo is reset on any create, write or delete.
+        '''
+        if self.id is None or self.id < 0:
+            return
+        cache = Transaction().get_cache()
+        key = 'product.template.measurement_code'
+        if key not in cache:
+            cache[key] = LRUDictTransaction(config.getint('cache', 'record'))
+        memo = cache[key]
+        memo.refresh()
+        try:
+            code = memo[self.id]
+        except KeyError:
+            count('product.template.memoized_measurement_code', False)
+            # measurement_code is loaded for the whole batch of instances
+            code = memo[self.id] = self.measurement_code
+        else:
+            count('product.template.memoized_measurement_code', True)
+        return code
+
+    def get_rec_name(self, name):
+        rec_name = super(Template, self).get_rec_name(name)
+        code = self.get_memoized_measurement_code()
+        if code:
+            rec_name += ' [' + code + ']'
+        return rec_name
+
+    @classmethod
+    def search_measurement_code(cls, name, clause):
+        '''
+        Search on the measurement code computed for the templates of the
+        catalogue (only the active ones unless active_test is False).
+        This scans the catalogue: store the code (store_measurement_code
+        option) to search it with an index.
+        '''
+        _, operator, value = clause[:3]
+        ids = []
+        all_ids = [t.id for t in cls.search([])]
+        for rows in cls._read_measurement_rows(all_ids):
+            codes = cls._get_measurement_codes_from_rows(rows)
+            ids.extend(i for i, c in codes.iteritems()
+                if match_code(c, operator, value))
+        return [('id', 'in', ids)]
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        domain = super(Template, cls).search_rec_name(name, clause)
+        if not STORE_MEASUREMENT_CODE:
+            return domain
+        if clause[1].startswith('!') or clause[1].startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        return [bool_op,
+            domain,
+            ('measurement_code',) + tuple(clause[1:]),
+            ]
+
+
+def _on_change_measurements(fname):
+    'Return the on_change method of fname which updates the measurements'
+    def on_change(self):
+        self._update_measurements()
+    on_change.__name__ = 'on_change_%s' % fname
+    # The volume and the code may use any measurement field
+    return fields.depends('type', *_MEASUREMENT_FIELDS)(on_change)
+
+for _fname in ['type'] + _MEASUREMENT_FIELDS:
+    setattr(Template, 'on_change_%s' % _fname,
+        _on_change_measurements(_fname))
+del _fname
+
+
+class Product:
+    __metaclass__ = PoolMeta
+    __name__ = 'product.product'
+
+    @classmethod
+    def create(cls, vlist):
+        Template = Pool().get('product.template')
+        products = super(Product, cls).create(vlist)
+        # The code of the variants is part of the measurement signature
+        templates = [p.template for p in products if p.code]
+        if (templates and Transaction().context.get(
+                    '_update_measurement_columns', True)):
+            Template.update_measurement_columns(templates)
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        Template = Pool().get('product.template')
+        update = Transaction().context.get('_update_measurement_columns',
+            True)
+        actions = iter(args)
+        templates = []
+        for products, values in zip(actions, actions):
+            if update and ('code' in values or 'template' in values):
+                templates.extend(p.template for p in products)
+        super(Product, cls).write(*args)
+        actions = iter(args)
+        for products, values in zip(actions, actions):
+            if update and ('code' in values or 'template' in values):
+                templates.extend(p.template for p in products)
+        if templates:
+            Template.update_measurement_columns(templates)
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        domain = super(Product, cls).search_rec_name(name, clause)
+        if not STORE_MEASUREMENT_CODE:
+            return domain
+        if clause[1].startswith('!') or clause[1].startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        return [bool_op,
+            domain,
+            ('template.measurement_code',) + tuple(clause[1:]),
+            ]
+
+    def get_rec_name(self, name):
+        rec_name = super(Product, self).get_rec_name(name)
+        code = self.template.get_memoized_measurement_code()
+        if code:
+            rec_name += ' [' + code + ']'
+        return rec_name
 
 
 class ProductMeasurementsShapeCreationAsk(ModelView):
@@ -298,49 +1553,60 @@ class ProductMeasurementsShapeCreationAsk(ModelView):
         'on_change_with_length_digits')
     height = fields.Float('Height',
         digits=(16, Eval('height_digits', 2)),
-        states={
-            'invisible': Eval('shape') == 'cylinder',
-            },
-        depends=['shape', 'height_digits'])
+        depends=['height_digits'])
     height_uom = fields.Many2One('product.uom', 'Height UoM',
         domain=[('category', '=', Id('product', 'uom_cat_length'))],
         states={
-            'invisible': Eval('shape') == 'cylinder',
             'required': Bool(Eval('height')),
             },
-        depends=['shape', 'height'])
+        depends=['height'])
     height_digits = fields.Function(fields.Integer('Height Digits'),
         'on_change_with_height_digits')
     width = fields.Float('Width',
         digits=(16, Eval('width_digits', 2)),
-        states={
-            'invisible': Eval('shape') == 'cylinder',
-            },
-        depends=['shape', 'width_digits'])
+        depends=['width_digits'])
     width_uom = fields.Many2One('product.uom', 'Width UoM',
         domain=[('category', '=', Id('product', 'uom_cat_length'))],
         states={
-            'invisible': Eval('shape') == 'cylinder',
             'required': Bool(Eval('width')),
             },
-        depends=['shape', 'width'])
+        depends=['width'])
     width_digits = fields.Function(fields.Integer('Width Digits'),
         'on_change_with_width_digits')
     diameter = fields.Float('Diameter',
         digits=(16, Eval('diameter_digits', 2)),
-        states={
-            'invisible': Eval('shape') != 'cylinder',
-            },
         depends=['diameter_digits'])
     diameter_uom = fields.Many2One('product.uom', 'Diameter UoM',
         domain=[('category', '=', Id('product', 'uom_cat_length'))],
         states={
-            'invisible': Eval('shape') != 'cylinder',
             'required': Bool(Eval('diameter')),
             },
-        depends=['shape', 'diameter'])
+        depends=['diameter'])
     diameter_digits = fields.Function(fields.Integer('Diameter Digits'),
         'on_change_with_diameter_digits')
+    inner_diameter = fields.Float('Inner Diameter',
+        digits=(16, Eval('inner_diameter_digits', 2)),
+        depends=['inner_diameter_digits'])
+    inner_diameter_uom = fields.Many2One('product.uom', 'Inner Diameter UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        states={
+            'required': Bool(Eval('inner_diameter')),
+            },
+        depends=['inner_diameter'])
+    inner_diameter_digits = fields.Function(
+        fields.Integer('Inner Diameter Digits'),
+        'on_change_with_inner_diameter_digits')
+    thickness = fields.Float('Thickness',
+        digits=(16, Eval('thickness_digits', 2)),
+        depends=['thickness_digits'])
+    thickness_uom = fields.Many2One('product.uom', 'Thickness UoM',
+        domain=[('category', '=', Id('product', 'uom_cat_length'))],
+        states={
+            'required': Bool(Eval('thickness')),
+            },
+        depends=['thickness'])
+    thickness_digits = fields.Function(fields.Integer('Thickness Digits'),
+        'on_change_with_thickness_digits')
     density = fields.Float('Density',
         digits=(16, Eval('density_digits', 2)),
         depends=['density_digits'])
@@ -358,10 +1624,20 @@ class ProductMeasurementsShapeCreationAsk(ModelView):
         depends=['density'])
     density_digits = fields.Function(fields.Integer('Density Digits'),
         'on_change_with_density_digits')
+    lengths = fields.Char('Other Lengths', help=_GRID_HELP)
+    heights = fields.Char('Other Heights', help=_GRID_HELP)
+    widths = fields.Char('Other Widths', help=_GRID_HELP)
+    diameters = fields.Char('Other Diameters', help=_GRID_HELP)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductMeasurementsShapeCreationAsk, cls).__setup__()
+        cls.shape.selection = shape_selection()
+        _update_shape_states(cls)
 
     @fields.depends('length_uom')
     def on_change_with_length_digits(self, name=None):
-        return (self.length_uom.digits if self.length_uom
+        return (_uom_digits(self.length_uom) if self.length_uom
             else self.default_length_digits())
 
     @staticmethod
@@ -370,7 +1646,7 @@ class ProductMeasurementsShapeCreationAsk(ModelView):
 
     @fields.depends('height_uom')
     def on_change_with_height_digits(self, name=None):
-        return (self.height_uom.digits if self.height_uom
+        return (_uom_digits(self.height_uom) if self.height_uom
             else self.default_height_digits())
 
     @staticmethod
@@ -379,7 +1655,7 @@ class ProductMeasurementsShapeCreationAsk(ModelView):
 
     @fields.depends('width_uom')
     def on_change_with_width_digits(self, name=None):
-        return (self.width_uom.digits if self.width_uom
+        return (_uom_digits(self.width_uom) if self.width_uom
             else self.default_width_digits())
 
     @staticmethod
@@ -388,16 +1664,35 @@ class ProductMeasurementsShapeCreationAsk(ModelView):
 
     @fields.depends('diameter_uom')
     def on_change_with_diameter_digits(self, name=None):
-        return (self.diameter_uom.digits if self.diameter_uom
+        return (_uom_digits(self.diameter_uom) if self.diameter_uom
             else self.default_diameter_digits())
 
     @staticmethod
     def default_diameter_digits():
         return 2
 
+    @fields.depends('inner_diameter_uom')
+    def on_change_with_inner_diameter_digits(self, name=None):
+        return (_uom_digits(self.inner_diameter_uom)
+            if self.inner_diameter_uom
+            else self.default_inner_diameter_digits())
+
+    @staticmethod
+    def default_inner_diameter_digits():
+        return 2
+
+    @fields.depends('thickness_uom')
+    def on_change_with_thickness_digits(self, name=None):
+        return (_uom_digits(self.thickness_uom) if self.thickness_uom
+            else self.default_thickness_digits())
+
+    @staticmethod
+    def default_thickness_digits():
+        return 2
+
     @fields.depends('density_weight_uom', 'density_volume_uom')
     def on_change_with_density_digits(self, name=None):
-        return (self.density_weight_uom.digits + self.density_volume_uom.digits
+        return (_uom_digits(self.density_weight_uom, self.density_volume_uom)
             if self.density_weight_uom and self.density_volume_uom
             else self.default_density_digits())
 
@@ -423,6 +1718,8 @@ class ProductMeasurementsShapeCreation(Wizard):
         cls._error_messages.update({
                 'not_unique_variant_code': ('The product "%s" is not variant '
                     'unique or does not have a code.'),
+                'invalid_grid_value': ('The value "%(value)s" of "%(field)s" '
+                    'is not a number.'),
                 })
 
     def default_start(self, fields):
@@ -438,48 +1735,67 @@ class ProductMeasurementsShapeCreation(Wizard):
             template = Template(context['active_id'])
 
         if not template.unique_variant or not template.code:
-            self.raise_user_error('not_unique_variant_code', (template.name,))
+            self.raise_user_error('not_unique_variant_code',
+                (template.rec_name,))
 
         default = {}
-        config = Config.get_singleton()
+        defaults = Config.get_measurement_defaults()
         default['shape'] = template.shape
         default['length'] = template.length
         default['height'] = template.height
         default['width'] = template.width
         default['diameter'] = template.diameter
+        default['inner_diameter'] = template.inner_diameter
+        default['thickness'] = template.thickness
         default['density'] = template.density
+        for fname in ('length_uom', 'height_uom', 'width_uom', 'diameter_uom',
+                'inner_diameter_uom', 'thickness_uom', 'density_weight_uom',
+                'density_volume_uom'):
+            uom = getattr(template, fname)
+            if uom:
+                default[fname] = uom.id
+            elif defaults[fname]:
+                default[fname] = defaults[fname]
 
-        if template.length_uom:
-            default['length_uom'] = template.length_uom.id
-        elif config and config.length_uom:
-            default['length_uom'] = config.length_uom.id
-
-        if template.height_uom:
-            default['height_uom'] = template.height_uom.id
-        elif config and config.height_uom:
-            default['height_uom'] = config.height_uom.id
-
-        if template.width_uom:
-            default['width_uom'] = template.width_uom.id
-        elif config and config.width_uom:
-            default['width_uom'] = config.width_uom.id
-
-        if template.diameter_uom:
-            default['diameter_uom'] = template.diameter_uom.id
-        elif config and config.diameter_uom:
-            default['diameter_uom'] = config.diameter_uom.id
-
-        if template.density_weight_uom:
-            default['density_weight_uom'] = template.density_weight_uom.id
-        elif config and config.density_weight_uom:
-            default['density_weight_uom'] = config.density_weight_uom.id
+        return default
 
-        if template.density_volume_uom:
-            default['density_volume_uom'] = template.density_volume_uom.id
-        elif config and config.density_volume_uom:
-            default['density_volume_uom'] = config.density_volume_uom.id
+    def _get_measurement_values(self):
+        'Return the measurement values of the start view with the UoM ids'
+        values = {}
+        for fname in ('shape', 'length', 'length_uom', 'height',
+                'height_uom', 'width', 'width_uom', 'diameter', 'diameter_uom',
+                'inner_diameter', 'inner_diameter_uom', 'thickness',
+                'thickness_uom', 'density', 'density_weight_uom',
+                'density_volume_uom'):
+            value = getattr(self.start, fname)
+            if isinstance(value, Model):
+                value = value.id
+            values[fname] = value
+        return values
 
-        return default
+    def _get_measurement_grid(self, values):
+        'Return the lists of values of each dimension for the size grid'
+        grid = {}
+        for fname, grid_fname in (('length', 'lengths'), ('height', 'heights'),
+                ('width', 'widths'), ('diameter', 'diameters')):
+            others = getattr(self.start, grid_fname)
+            if not others:
+                continue
+            sizes = [values[fname]] if values[fname] else []
+            for value in others.split(';'):
+                value = value.strip()
+                if not value:
+                    continue
+                try:
+                    sizes.append(float(value))
+                except ValueError:
+                    self.raise_user_error('invalid_grid_value', {
+                            'value': value,
+                            'field': self.start._fields[grid_fname].string,
+                            })
+            if sizes:
+                grid[fname] = sizes
+        return grid
 
     def do_create_(self, action):
         Template = Pool().get('product.template')
@@ -492,38 +1808,16 @@ class ProductMeasurementsShapeCreation(Wizard):
         else:
             template = Template(context['active_id'])
 
-        templates = Template.search([
-                ('code', '=', template.code),
-                ('shape', '=', self.start.shape),
-                ('length', '=', self.start.length),
-                ('height', '=', self.start.height),
-                ('width', '=', self.start.width),
-                ('diameter', '=', self.start.diameter),
-                ('density', '=', self.start.density),
-                ('length_uom', '=', self.start.length_uom),
-                ('height_uom', '=', self.start.height_uom),
-                ('width_uom', '=', self.start.width_uom),
-                ('diameter_uom', '=', self.start.diameter_uom),
-                ('density_weight_uom', '=', self.start.density_weight_uom),
-                ('density_volume_uom', '=', self.start.density_volume_uom),
-                ], limit=1)
-        if not templates:
-            new_template, = Template.copy([template], {
-                    'shape': self.start.shape,
-                    'length': self.start.length,
-                    'height': self.start.height,
-                    'width': self.start.width,
-                    'diameter': self.start.diameter,
-                    'density': self.start.density,
-                    'length_uom': self.start.length_uom,
-                    'height_uom': self.start.height_uom,
-                    'width_uom': self.start.width_uom,
-                    'diameter_uom': self.start.diameter_uom,
-                    'density_weight_uom': self.start.density_weight_uom,
-                    'density_volume_uom': self.start.density_volume_uom,
-                    })
-        else:
-            new_template, = templates
+        values = self._get_measurement_values()
+        templates = Template.find_or_create_measurement_variants(template,
+            measurement_grid(values, self._get_measurement_grid(values)))
+        templates = list(OrderedDict.fromkeys(templates))
+        if len(templates) > 1:
+            action['pyson_domain'] = PYSONEncoder().encode([
+                    ('id', 'in', [t.id for t in templates]),
+                    ])
+            return action, {}
+        new_template, = templates
 
         action['pyson_context'] = PYSONEncoder().encode({
                 'product': new_template.id,
@@ -532,3 +1826,99 @@ class ProductMeasurementsShapeCreation(Wizard):
                 ('id', '=', new_template.id),
                 ])
         return action, {}
+
+
+class ProductMeasurementsRecomputeQueue(ModelSQL):
+    'Product Measurements Recompute Queue'
+    __name__ = 'product.measurements_recompute.queue'
+    template = fields.Many2One('product.template', 'Template', required=True,
+        select=True, ondelete='CASCADE')
+
+
+class ProductMeasurementsRecomputeStart(ModelView):
+    'Product Measurements Recompute Start'
+    __name__ = 'product.measurements_recompute.start'
+    overwrite_weight = fields.Boolean('Overwrite Weight',
+        help='Replace the weight already set with the one computed from the '
+        'measurements and density. Otherwise only the missing weights are '
+        'computed.')
+
+    @staticmethod
+    def default_overwrite_weight():
+        return False
+
+
+class ProductMeasurementsRecompute(Wizard):
+    'Product Measurements Recompute'
+    __name__ = 'product.measurements_recompute'
+    start = StateView('product.measurements_recompute.start',
+        'product_measurements_shape.product_measurements_recompute_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Recompute', 'recompute', 'tryton-ok', default=True),
+            ])
+    recompute = StateTransition()
+
+    def transition_recompute(self):
+        Template = Pool().get('product.template')
+        context = Transaction().context
+        templates = None
+        if context.get('active_model') == 'product.template':
+            templates = Template.browse(context['active_ids'])
+        Template.recompute_measurements(templates,
+            overwrite=self.start.overwrite_weight)
+        return 'end'
+
+
+class ProductMeasurementsExportStart(ModelView):
+    'Product Measurements Export Start'
+    __name__ = 'product.measurements_export.start'
+    format_ = fields.Selection([
+            ('csv', 'CSV'),
+            ('json', 'JSON'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_format_():
+        return 'csv'
+
+
+class ProductMeasurementsExportResult(ModelView):
+    'Product Measurements Export Result'
+    __name__ = 'product.measurements_export.result'
+    file = fields.Binary('File', readonly=True, filename='filename')
+    filename = fields.Char('File Name', readonly=True)
+
+
+class ProductMeasurementsExport(Wizard):
+    'Product Measurements Export'
+    __name__ = 'product.measurements_export'
+    start = StateView('product.measurements_export.start',
+        'product_measurements_shape.product_measurements_export_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('product.measurements_export.result',
+        'product_measurements_shape.product_measurements_export_result_view_form',
+        [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        Template = Pool().get('product.template')
+        context = Transaction().context
+        ids = None
+        if context.get('active_model') == 'product.template':
+            ids = context['active_ids']
+        format_ = self.start.format_
+        # Spool the lines to not hold them and the joined file in memory
+        with TemporaryFile() as file_:
+            for line in Template.iter_export_measurements(format_, ids):
+                file_.write(line.encode('utf-8'))
+            file_.seek(0)
+            data = file_.read()
+        return {
+            'file': data,
+            'filename': 'product_measurements.%s' % format_,
+            }
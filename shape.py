@@ -0,0 +1,139 @@
+# This file is part product_measurements_shape module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Registry of the shapes of the products.
+
+Each shape declares the dimension fields it requires, a scalar function
+returning the volume from the dimensions and a batch function returning the
+volumes from one list of values per dimension. All dimensions are in meters
+and volumes in cubic meters.
+
+Other modules can add shapes calling register_shape() when they are imported.
+'''
+from collections import namedtuple, OrderedDict
+from itertools import izip
+from math import pi, sqrt
+
+__all__ = ['DIMENSIONS', 'SHAPES', 'Shape', 'register_shape',
+    'shape_selection', 'shapes_with', 'shape_volume', 'shape_volumes']
+
+# Dimension fields which can be used by a shape
+DIMENSIONS = ['length', 'height', 'width', 'diameter', 'inner_diameter',
+    'thickness']
+
+Shape = namedtuple('Shape', ['name', 'string', 'dimensions', 'volume',
+        'batch_volume'])
+
+SHAPES = OrderedDict()
+
+
+def register_shape(name, string, dimensions, volume, batch_volume=None):
+    '''
+    Register the shape name with its label, the tuple of dimension names
+    passed in order to the volume functions, the scalar volume function and
+    the batch volume function (by default the scalar one applied to each
+    row).
+    '''
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            raise ValueError('Unknown dimension "%s".' % dimension)
+    if batch_volume is None:
+        def batch_volume(*columns):
+            return [volume(*row) for row in izip(*columns)]
+    SHAPES[name] = Shape(name, string, tuple(dimensions), volume,
+        batch_volume)
+
+
+def shape_selection():
+    'Return the selection of the shape fields'
+    return [(None, 'None')] + [(s.name, s.string) for s in SHAPES.itervalues()]
+
+
+def shapes_with(dimension):
+    'Return the names of the shapes which use the dimension'
+    return [s.name for s in SHAPES.itervalues() if dimension in s.dimensions]
+
+
+def shape_volume(shape, dimensions):
+    '''
+    Return the volume of the shape from the dictionary of dimensions or None
+    if the shape is unknown, a dimension is missing or the volume is not
+    positive.
+    '''
+    shape = SHAPES.get(shape)
+    if not shape:
+        return
+    values = [dimensions.get(d) for d in shape.dimensions]
+    if not all(values):
+        return
+    volume = shape.volume(*values)
+    if volume > 0:
+        return volume
+
+
+def shape_volumes(shape, rows):
+    '''
+    Return the volumes of the shape for a list of dictionaries of dimensions
+    using the batch function of the shape. Same rules as shape_volume.
+    '''
+    volumes = [None] * len(rows)
+    shape = SHAPES.get(shape)
+    if not shape:
+        return volumes
+    indexes = [i for i, r in enumerate(rows)
+        if all(r.get(d) for d in shape.dimensions)]
+    if not indexes:
+        return volumes
+    columns = [[rows[i][d] for i in indexes] for d in shape.dimensions]
+    for i, volume in izip(indexes, shape.batch_volume(*columns)):
+        if volume > 0:
+            volumes[i] = volume
+    return volumes
+
+
+def _parallelepipeds(length, height, width):
+    return [l * h * w for l, h, w in izip(length, height, width)]
+
+
+def _cylinders(length, diameter):
+    return [pi * d * d * l / 4.0 for l, d in izip(length, diameter)]
+
+
+def _tubes(length, diameter, inner_diameter):
+    return [pi * (d * d - i * i) * l / 4.0
+        for l, d, i in izip(length, diameter, inner_diameter)]
+
+
+def _hexagonal_bars(length, width):
+    # width is the distance across flats
+    return [sqrt(3) / 2.0 * w * w * l for l, w in izip(length, width)]
+
+
+def _spheres(diameter):
+    return [pi * d * d * d / 6.0 for d in diameter]
+
+
+def _l_profiles(length, height, width, thickness):
+    return [t * (h + w - t) * l
+        for l, h, w, t in izip(length, height, width, thickness)]
+
+
+def _scalar(batch_volume):
+    def volume(*values):
+        return batch_volume(*[[v] for v in values])[0]
+    return volume
+
+
+for _name, _string, _dimensions, _batch_volume in (
+        ('parallelepiped', 'Parallelepiped', ('length', 'height', 'width'),
+            _parallelepipeds),
+        ('cylinder', 'Cylinder', ('length', 'diameter'), _cylinders),
+        ('tube', 'Tube', ('length', 'diameter', 'inner_diameter'), _tubes),
+        ('hexagonal', 'Hexagonal Bar', ('length', 'width'), _hexagonal_bars),
+        ('sphere', 'Sphere', ('diameter',), _spheres),
+        ('l_profile', 'L-Profile', ('length', 'height', 'width', 'thickness'),
+            _l_profiles),
+        ):
+    register_shape(_name, _string, _dimensions, _scalar(_batch_volume),
+        _batch_volume)
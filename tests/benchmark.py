@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# This file is part of the product_measurements_shape module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the product_measurements_shape module.
+
+It seeds templates with mixed shapes and UoMs in a new database (in-memory
+SQLite by default) and prints the timings as JSON:
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.product_measurements_shape.tests.benchmark 1000 10000
+'''
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+from decimal import Decimal
+
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond import __version__
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import (DB_NAME, USER, CONTEXT,
+    install_module, drop_create, drop_db)
+
+MODULE = 'product_measurements_shape'
+SIZES = [1000, 10000, 50000]
+SYNTAXES = {
+    'template': (
+        'parallelepiped: {width}{width_uom} x {height}{height_uom} x '
+        '{length}{length_uom}\n'
+        'tube: {diameter}{diameter_uom} / {inner_diameter}'
+        '{inner_diameter_uom} x {length}{length_uom}\n'
+        '*: [{diameter}{diameter_uom}][ x {length}{length_uom}]'),
+    }
+
+
+def _timing(func, number, repeat):
+    'Return the best and mean time in seconds of one call of func'
+    times = [t / number for t in timeit.repeat(func, number=number,
+            repeat=repeat)]
+    return {
+        'best': min(times),
+        'mean': sum(times) / len(times),
+        'number': number,
+        'repeat': repeat,
+        }
+
+
+def _uoms():
+    ModelData = Pool().get('ir.model.data')
+    return dict((name, ModelData.get_id('product', 'uom_' + name))
+        for name in ('unit', 'meter', 'centimeter', 'millimeter',
+            'kilogram', 'gram', 'liter', 'cubic_meter'))
+
+
+def _measurement_values(rng, uoms):
+    'Return random measurement values of one of the shapes'
+    lengths = [uoms['meter'], uoms['centimeter'], uoms['millimeter']]
+    shape = rng.choice(['parallelepiped', 'cylinder', 'tube', 'hexagonal',
+            'sphere', 'l_profile'])
+    values = {'shape': shape}
+    for fname in ('length', 'height', 'width', 'diameter', 'thickness'):
+        values[fname] = round(rng.uniform(1, 100), 2)
+        values[fname + '_uom'] = rng.choice(lengths)
+    values['inner_diameter'] = round(values['diameter'] * 0.8, 2)
+    values['inner_diameter_uom'] = values['diameter_uom']
+    values['weight_uom'] = rng.choice([uoms['kilogram'], uoms['gram']])
+    values['density'] = round(rng.uniform(500, 9000), 2)
+    values['density_weight_uom'] = uoms['kilogram']
+    values['density_volume_uom'] = uoms['cubic_meter']
+    return values
+
+
+def seed(size, rng, uoms):
+    'Create size templates with one product each and return their ids'
+    Template = Pool().get('product.template')
+    ids = []
+    for start in xrange(0, size, 1000):
+        vlist = []
+        for i in xrange(start, min(start + 1000, size)):
+            values = _measurement_values(rng, uoms)
+            values.update({
+                    'name': 'Product %s' % i,
+                    'type': 'goods',
+                    'default_uom': uoms['unit'],
+                    'list_price': Decimal(0),
+                    'cost_price': Decimal(0),
+                    'unique_variant': True,
+                    'products': [('create', [{'code': 'P%06d' % i}])],
+                    })
+            vlist.append(values)
+        ids.extend(t.id for t in Template.create(vlist))
+    return ids
+
+
+def bench_read(ids, page, number, repeat):
+    'Read the record names and codes of a tree page'
+    Template = Pool().get('product.template')
+    page_ids = ids[:page]
+
+    def read():
+        Template.read(page_ids, ['rec_name', 'measurement_code'])
+    return _timing(read, number, repeat)
+
+
+def bench_on_change(rng, uoms, calls, repeat):
+    'Compute weight, density, volume and code of unsaved templates'
+    Template = Pool().get('product.template')
+    templates = []
+    for _ in xrange(calls):
+        values = _measurement_values(rng, uoms)
+        values['type'] = 'goods'
+        templates.append(Template(**values))
+
+    def weight():
+        for template in templates:
+            template.weight = None
+            template.on_change_length()
+
+    def density():
+        for template in templates:
+            template.weight = 1
+            template.density = None
+            template.on_change_weight()
+    return {
+        'weight': _timing(weight, 1, repeat),
+        'density': _timing(density, 1, repeat),
+        'calls': calls,
+        }
+
+
+def bench_check_formula(number, repeat):
+    'Check the formula on the synthetic and the existing templates'
+    Config = Pool().get('product.configuration')
+    config = Config(1)
+
+    def check():
+        config.check_formula()
+        config.check_formula_records(config.measurement_code_formula,
+            config.measurement_code_syntax)
+    return _timing(check, number, repeat)
+
+
+def bench_shape_creation(template_id, number, repeat):
+    'Run the creation wizard finding the same product (hit) or a new one'
+    pool = Pool()
+    Wizard = pool.get('product.measurements_shape_creation', type='wizard')
+    Ask = pool.get('product.measurements_shape_creation.ask')
+    counter = [0]
+
+    def run(miss):
+        with Transaction().set_context(active_model='product.template',
+                active_id=template_id):
+            session_id, _, _ = Wizard.create()
+            wizard = Wizard(session_id)
+            values = wizard.default_start(None)
+            # The fields without default (like the size grid) are empty
+            for fname in Ask._fields:
+                values.setdefault(fname, None)
+            if miss:
+                counter[0] += 1
+                values['length'] = (values['length'] or 0) + counter[0]
+            wizard.start = Ask(**values)
+            wizard.do_create_({})
+            Wizard.delete(session_id)
+    return {
+        'hit': _timing(lambda: run(False), number, repeat),
+        'miss': _timing(lambda: run(True), number, repeat),
+        }
+
+
+def benchmark(size, args):
+    rng = random.Random(size)
+    result = {'size': size, 'syntaxes': {}}
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        pool = Pool()
+        Config = pool.get('product.configuration')
+        uoms = _uoms()
+        start = timeit.default_timer()
+        ids = seed(size, rng, uoms)
+        result['seed'] = timeit.default_timer() - start
+        for syntax in ['python'] + sorted(SYNTAXES):
+            values = {'measurement_code_syntax': syntax}
+            if syntax in SYNTAXES:
+                values['measurement_code_formula'] = SYNTAXES[syntax]
+            Config.write([Config(1)], values)
+            result['syntaxes'][syntax] = {
+                'read': bench_read(ids, args.page, args.number, args.repeat),
+                'check_formula': bench_check_formula(args.number,
+                    args.repeat),
+                }
+        result['on_change'] = bench_on_change(rng, uoms, args.calls,
+            args.repeat)
+        result['shape_creation'] = bench_shape_creation(ids[0],
+            args.number, args.repeat)
+        Transaction().rollback()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES,
+        help='number of templates to seed (default: %(default)s)')
+    parser.add_argument('--page', type=int, default=1000,
+        help='number of records of a tree page (default: %(default)s)')
+    parser.add_argument('--calls', type=int, default=1000,
+        help='number of on_change calls (default: %(default)s)')
+    parser.add_argument('--number', type=int, default=10,
+        help='calls by timing (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='repetitions of each timing (default: %(default)s)')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default=sys.stdout, help='JSON output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    drop_create()
+    install_module(MODULE)
+    try:
+        results = [benchmark(size, args) for size in args.sizes]
+    finally:
+        drop_db()
+    json.dump({
+            'module': MODULE,
+            'trytond': __version__,
+            'database': DB_NAME,
+            'results': results,
+            }, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
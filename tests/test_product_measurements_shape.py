@@ -2,17 +2,286 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import unittest
+import doctest
+from decimal import Decimal
+from math import pi
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import doctest_setup, doctest_teardown
+from trytond.tests.test_tryton import doctest_checker
+from trytond.pool import Pool
+from trytond.exceptions import UserError
+from trytond.modules.product_measurements_shape.product import (
+    STORE_MEASUREMENT_CODE)
 
 
 class ProductMeasurementsShapeTestCase(ModuleTestCase):
     'Test Product Measurements Shape module'
     module = 'product_measurements_shape'
 
+    def test_code_template(self):
+        'Test measurement code template syntax'
+        from trytond.modules.product_measurements_shape.formula import (
+            CODE_TEMPLATE_FIELDS, compile_code_template)
+
+        def row(**values):
+            return tuple(values.get(f) for f in CODE_TEMPLATE_FIELDS)
+
+        render = compile_code_template(
+            'parallelepiped: {length:.0f}x{width:.0f}[x{height:.0f}]'
+            '{length_uom}\n'
+            '*: D{diameter}[[{{{diameter_uom}}}]]')
+        self.assertEqual(render(row(type='goods', shape='parallelepiped',
+                    length=10., width=5., length_uom='cm')), u'10x5cm')
+        self.assertEqual(render(row(type='goods', shape='parallelepiped',
+                    length=10., width=5., height=2., length_uom='cm')),
+            u'10x5x2cm')
+        self.assertEqual(render(row(type='goods', shape='cylinder',
+                    diameter=3, diameter_uom='m')), u'D3[{m}]')
+        self.assertEqual(render(row(type='service', shape='cylinder',
+                    diameter=3)), u'')
+        for formula in ('missing colon', '*: {unknown}', '*: [x', '*: x]',
+                '*: [[x]'):
+            self.assertRaises(ValueError, compile_code_template, formula)
+
+    def test_shape_volumes(self):
+        'Test shape volume functions'
+        from trytond.modules.product_measurements_shape.shape import (
+            shape_volume, shape_volumes)
+
+        rows = [
+            {'length': 2., 'diameter': 1.},
+            {'length': 2.},
+            {'length': 1., 'diameter': 0.1, 'inner_diameter': 0.2},
+            ]
+        self.assertAlmostEqual(shape_volume('cylinder', rows[0]), pi / 2)
+        self.assertEqual(shape_volume('cylinder', rows[1]), None)
+        self.assertEqual(shape_volume('tube', rows[2]), None)
+        self.assertEqual(shape_volume('unknown', rows[0]), None)
+        self.assertAlmostEqual(shape_volume('sphere', {'diameter': 1.}),
+            pi / 6)
+        self.assertAlmostEqual(shape_volume('l_profile', {
+                    'length': 1., 'height': .1, 'width': .1,
+                    'thickness': .01}), .0019)
+        volumes = shape_volumes('cylinder', rows)
+        self.assertAlmostEqual(volumes[0], pi / 2)
+        self.assertEqual(volumes[1], None)
+        self.assertAlmostEqual(volumes[2], pi / 400)
+
+    def test_match_code(self):
+        'Test measurement code search matching'
+        from trytond.modules.product_measurements_shape.product import (
+            match_code)
+
+        code = u'10x5_2cm'
+        self.assertTrue(match_code(code, '=', code))
+        self.assertTrue(match_code(code, '!=', u'10x5'))
+        self.assertTrue(match_code(code, 'like', u'10x%'))
+        self.assertFalse(match_code(code, 'like', u'%CM'))
+        self.assertTrue(match_code(code, 'ilike', u'%CM'))
+        self.assertTrue(match_code(code, 'like', u'10x5\\_2%'))
+        self.assertFalse(match_code(u'10x5x2cm', 'like', u'10x5\\_2%'))
+        self.assertTrue(match_code(code, 'not ilike', u'%mm'))
+        self.assertTrue(match_code(code, 'in', [code]))
+        self.assertTrue(match_code(None, 'not in', [code]))
+        self.assertFalse(match_code(None, 'ilike', u'%'))
+
+    def test_nearest_sizes(self):
+        'Test nearest sizes search'
+        from trytond.modules.product_measurements_shape.product import (
+            nearest_sizes)
+
+        # (length, diameter) of cylinders
+        index = sorted([
+                ((2.5, .020), 1),
+                ((2.5, .025), 2),
+                ((3., .022), 3),
+                ((2.4, .022), 4),
+                ((None, .022), 5),
+                ((6., .022), 6),
+                ])
+        query = [(0, 2.5), (1, .022)]
+        self.assertEqual(nearest_sizes(index, query), [4])
+        self.assertEqual(nearest_sizes(index, query, 3), [4, 1, 2])
+        self.assertEqual(nearest_sizes(index, query, 2, not_smaller=[0, 1]),
+            [2, 3])
+        self.assertEqual(nearest_sizes(index, [(1, .022)], 3), [3, 4, 5])
+        self.assertEqual(nearest_sizes(index, [(1, .022)], 1,
+                not_smaller=[1]), [3])
+        self.assertEqual(nearest_sizes(index, query, 10),
+            [4, 1, 2, 3, 6])
+        self.assertEqual(nearest_sizes([], query), [])
+
+    @with_transaction()
+    def test_find_nearest_sizes(self):
+        'Test nearest sizes of templates with the same code'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
+        meter = Uom(ModelData.get_id('product', 'uom_meter'))
+        millimeter = Uom(ModelData.get_id('product', 'uom_millimeter'))
+        bar20, bar22, bar25, other = Template.create([{
+                    'name': 'Bar',
+                    'type': 'goods',
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'default_uom': unit.id,
+                    'shape': 'cylinder',
+                    'diameter': diameter,
+                    'diameter_uom': millimeter.id,
+                    'length': 2.5,
+                    'length_uom': meter.id,
+                    'products': [('create', [{
+                                    'code': code,
+                                    }])],
+                    } for code, diameter in [
+                    ('BAR', 20), ('BAR', 22), ('BAR', 25), ('OTHER', 23)]])
+
+        self.assertEqual(Template.find_nearest_sizes('BAR', 'cylinder',
+                {'diameter': 22.4}, uom=millimeter), [bar22])
+        self.assertEqual(Template.find_nearest_sizes('BAR', 'cylinder',
+                {'diameter': 22.4, 'length': 2500}, k=2,
+                not_smaller=['diameter'], uom=millimeter), [bar25])
+        self.assertEqual(Template.find_nearest_sizes('BAR', 'cylinder',
+                {'diameter': .0205}, k=3), [bar20, bar22, bar25])
+        self.assertEqual(Template.find_nearest_sizes('BAR', 'sphere',
+                {'diameter': .021}), [])
+        self.assertRaises(ValueError, Template.find_nearest_sizes, 'BAR',
+            'cylinder', {'width': .021})
+
+        # The index is refreshed when the measurements change
+        Template.write([bar25], {'diameter': 23})
+        self.assertEqual(Template.find_nearest_sizes('BAR', 'cylinder',
+                {'diameter': 22.6}, uom=millimeter), [bar25])
+
+    @with_transaction()
+    def test_compute_measurement_totals(self):
+        'Test weight and volume totals of template quantities'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
+        meter = Uom(ModelData.get_id('product', 'uom_meter'))
+        centimeter = Uom(ModelData.get_id('product', 'uom_centimeter'))
+        millimeter = Uom(ModelData.get_id('product', 'uom_millimeter'))
+        kilogram = Uom(ModelData.get_id('product', 'uom_kilogram'))
+        gram = Uom(ModelData.get_id('product', 'uom_gram'))
+        liter = Uom(ModelData.get_id('product', 'uom_liter'))
+        cubic_meter = Uom(ModelData.get_id('product', 'uom_cubic_meter'))
+        plate, bar = Template.create([{
+                    'name': 'Plate',
+                    'type': 'goods',
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'default_uom': unit.id,
+                    'shape': 'parallelepiped',
+                    'width': 10,
+                    'width_uom': centimeter.id,
+                    'height': 5,
+                    'height_uom': centimeter.id,
+                    'length': 2,
+                    'length_uom': meter.id,
+                    'weight_uom': kilogram.id,
+                    'density': 7850,
+                    'density_weight_uom': kilogram.id,
+                    'density_volume_uom': cubic_meter.id,
+                    }, {
+                    'name': 'Bar',
+                    'type': 'goods',
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'default_uom': unit.id,
+                    'shape': 'cylinder',
+                    'diameter': 20,
+                    'diameter_uom': millimeter.id,
+                    'length': 3,
+                    'length_uom': meter.id,
+                    }])
+        self.assertEqual(plate.weight, 78.5)
+
+        totals = Template.compute_measurement_totals([
+                (plate, 2, unit),
+                (bar, 3, None),
+                ], kilogram, liter)
+        (plate_weight, plate_volume), (bar_weight, bar_volume) = (
+            totals['lines'])
+        self.assertAlmostEqual(plate_weight, 157.)
+        self.assertAlmostEqual(plate_volume, 20.)
+        self.assertEqual(bar_weight, None)
+        self.assertAlmostEqual(bar_volume, 0.9 * pi)
+        self.assertAlmostEqual(totals['weight'], 157.)
+        self.assertAlmostEqual(totals['volume'], 20. + 0.9 * pi)
+
+        totals = Template.compute_measurement_totals([(plate, 1, unit)],
+            gram, cubic_meter)
+        self.assertAlmostEqual(totals['weight'], 78500.)
+        self.assertAlmostEqual(totals['volume'], .01)
+
+    @with_transaction()
+    def test_check_formula_time_budget(self):
+        'Test formula time budget on the existing templates'
+        from trytond.modules.product_measurements_shape import configuration
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        Configuration = pool.get('product.configuration')
+
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
+        meter = Uom(ModelData.get_id('product', 'uom_meter'))
+        Template.create([{
+                    'name': 'Bar',
+                    'type': 'goods',
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'default_uom': unit.id,
+                    'shape': 'cylinder',
+                    'diameter': .02,
+                    'diameter_uom': meter.id,
+                    'length': 3,
+                    'length_uom': meter.id,
+                    }])
+        config, = Configuration.create([{}])
+        formula = config.measurement_code_formula
+        budget = configuration.FORMULA_TIME_BUDGET
+        configuration.FORMULA_TIME_BUDGET = 0.
+        try:
+            self.assertRaises(UserError, config.check_formula_records,
+                formula, 'python')
+            # The default formula is a byte string
+            self.assertRaises(UserError, config.check_formula_records,
+                Configuration.default_measurement_code_formula(), 'python')
+            # Only the changes of the formula are checked on the templates
+            Configuration.write([config], {
+                    'shape': 'cylinder',
+                    })
+            self.assertRaises(UserError, Configuration.write, [config], {
+                    'measurement_code_formula': formula,
+                    })
+        finally:
+            configuration.FORMULA_TIME_BUDGET = budget
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         ProductMeasurementsShapeTestCase))
+    suite.addTests(doctest.DocFileSuite(
+            'scenario_product_measurements_shape.rst',
+            setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
+            checker=doctest_checker,
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    # The code is only stored with the store_measurement_code option of the
+    # trytond configuration file
+    if STORE_MEASUREMENT_CODE:
+        suite.addTests(doctest.DocFileSuite(
+                'scenario_product_measurements_shape_stored_code.rst',
+                setUp=doctest_setup, tearDown=doctest_teardown,
+                encoding='utf-8', checker=doctest_checker,
+                optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
     return suite
\ No newline at end of file
@@ -0,0 +1,65 @@
+# This file is part product_measurements_shape module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from .instrumentation import count
+
+__all__ = ['Uom']
+
+_METADATA_FIELDS = ['symbol', 'digits', 'factor', 'rate']
+
+
+class Uom:
+    __metaclass__ = PoolMeta
+    __name__ = 'product.uom'
+    _measurement_metadata_cache = Cache('product_uom.measurement_metadata',
+        context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        uoms = super(Uom, cls).create(vlist)
+        cls._clear_measurement_caches()
+        return uoms
+
+    @classmethod
+    def write(cls, *args):
+        Template = Pool().get('product.template')
+        super(Uom, cls).write(*args)
+        cls._clear_measurement_caches()
+        actions = iter(args)
+        to_recompute = []
+        for uoms, values in zip(actions, actions):
+            if set(values) & set(_METADATA_FIELDS):
+                to_recompute.extend(uoms)
+        if to_recompute:
+            Template.enqueue_measurement_recompute(uoms=to_recompute)
+
+    @classmethod
+    def delete(cls, uoms):
+        super(Uom, cls).delete(uoms)
+        cls._clear_measurement_caches()
+
+    @classmethod
+    def _clear_measurement_caches(cls):
+        Template = Pool().get('product.template')
+        cls._measurement_metadata_cache.clear()
+        Template._measurement_code_memo.clear()
+
+    @classmethod
+    def get_measurement_metadata(cls):
+        '''
+        Return the symbol, digits, factor and rate of all UoMs keyed by id.
+        The values are cached by database and language and must not be
+        modified.
+        '''
+        language = Transaction().language
+        metadata = cls._measurement_metadata_cache.get(language)
+        count('product.uom.measurement_metadata_cache', metadata is not None)
+        if metadata is None:
+            with Transaction().set_context(active_test=False):
+                metadata = dict((u['id'], u) for u in cls.search_read([],
+                        fields_names=_METADATA_FIELDS))
+            cls._measurement_metadata_cache.set(language, metadata)
+        return metadata